@@ -11,6 +11,7 @@ import pandas as pd
 import cPickle as pickle
 from openpyxl import load_workbook
 import xlrd
+from synbiomts import dbms
 
 def add_dataset(db,datasets):
 
@@ -51,7 +52,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''Amin Espah Borujeni, Bennis M. Mishler, Jingzhi Wang, Walker Huso, & Howard M. Salis
@@ -84,7 +85,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''Amin Espah Borujeni, Howard M. Salis
@@ -113,7 +114,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)        
+        db.stage(df)
 
 
     '''Amin Espah Borujeni, Daniel P. Cetnar, Howard M. Salis
@@ -142,7 +143,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''
@@ -174,7 +175,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''Howard M. Salis, Ethan A. Mirsky, & Christopher A. Voigt
@@ -221,7 +222,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''Iman Farasat, Manish Kushwaha, Jason Collens, Michael Easterbrook, Matthew Guido, & Howard M. Salis
@@ -252,7 +253,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)        
+        db.stage(df)
 
 
     '''Tian Tian, & Howard M. Salis
@@ -281,7 +282,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''Mark Mimee, Alex C. Tucker, Christopher A. Voigt, and Timothy K. Lu
@@ -310,7 +311,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''Mads T Bonde, Margit Pederse, Michael S Klausen, Sheila I Jensen, Tune Wulff, Scott Harrison, Alex T Nielsen, Markus J Herrgard, Morten O A Sommer
@@ -340,7 +341,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''Robert G Egbert and Eric Klavins
@@ -369,7 +370,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["5pUTR"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
     '''Ariel Hecht, Jeff Glasgow, Paul R. Jaschke, Lukmaan A. Bawazer, Drew Endy, Marc Salit
     Measurements of translation initiation from all 64 codons in E. coli
@@ -399,7 +400,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = len(ds["5pUTR"])
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
         sheet = wb.sheet_by_name('Figure 3C')
         ds = {
@@ -421,7 +422,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = len(ds["5pUTR"])        
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
         sheet = wb.sheet_by_name('Figure 2')
         ds = {
@@ -443,7 +444,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = len(ds["5pUTR"])        
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
     '''Heather J. Beck, Ian M. C. Fleming, Gary R. Janssen
     5'-Terminal AUGs in Escherichia coli mRNAs with Shine-Dalgarno Sequences:
@@ -476,7 +477,7 @@ def add_dataset(db,datasets):
         ds["STARTPOS"] = [len(UTR) for UTR in ds["ORF"]]
 
         df = pd.DataFrame(ds)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
     '''Sriram Kosuri, Daniel B. Goodman, George M. Church
     Composability of regulatory sequences controlling transcription and translation in Escherichia coli
@@ -577,7 +578,7 @@ def add_dataset(db,datasets):
 
         df = calc_Flowseq(df,data)
         df = filter_Flowseq(df)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''Daniel B. Goodman, George M. Church, Sriram Kosuri
@@ -655,7 +656,7 @@ def add_dataset(db,datasets):
         
         df = calc_Flowseq(df,data)
         df = filter_Flowseq(df)
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
 
     '''Mads T Bonde, Margit Pederse, Michael S Klausen, Sheila I Jensen, Tune Wulff, Scott Harrison, Alex T Nielsen, Markus J Herrgard, Morten O A Sommer
@@ -701,9 +702,9 @@ def add_dataset(db,datasets):
 
         df['PROT.PERCENT'] = (df['PROT.MEAN']-Exp_TTGGGC)/(Exp_AGGAGA-Exp_TTGGGC)
 
-        db = db.append(df, ignore_index=True)
+        db.stage(df)
 
-        print db.head()
+        print df.head()
 
     '''Data collected for this work'''
     for paper in ['Reis1_2018','Reis2_2018']:
@@ -730,10 +731,14 @@ def add_dataset(db,datasets):
             df['SEQUENCE'] = df['5pUTR'] + df['CDS']
             df['STARTPOS'] = df['5pUTR'].map(len)
 
-            db = db.append(df, ignore_index=True)
+            db.stage(df)
 
-    # Clean up, define categories based on organism/host/dataset
-    db = _make_categories(db)
+    # Concatenate all datasets at once,
+    # with categories based on organism/host/dataset (categories save some memory)
+    db.commit(categories=["PROTEIN","ORGANISM","METHOD","DATASET"])
+
+    # Clean up, define sub-groups
+    db = _make_categories(db.data)
 
     # Remove unicode strings
     db = _remove_unicode(db)
@@ -741,13 +746,6 @@ def add_dataset(db,datasets):
     return db
 
 def _make_categories(db):
-    # categories save some memory
-
-    db["PROTEIN"]  = db["PROTEIN"].astype('category')
-    db["ORGANISM"] = db["ORGANISM"].astype('category')
-    db["METHOD"]   = db["METHOD"].astype('category')
-    db["DATASET"]  = db["DATASET"].astype('category')
-
     # And let's define sub-groups of sequences categorized:
     # At the same time, in the same organism, with the same promoter, and same experimental conditions
     info = ["{}+{}+{}+{}".format(d,o,g,p) for d,o,g,p in zip(db["DATASET"],db["ORGANISM"],db["PROTEIN"],db["PLASMID"])]
@@ -875,7 +873,7 @@ if __name__ == "__main__":
 
     # datasets = ['Bonde_NatMethods_FS_2016']
 
-    db = pd.DataFrame()
+    db = dbms.DataBase()
     db = add_dataset(db,datasets)
     
     handle = open('geneticsystems.db','w')
@@ -52,7 +52,7 @@ dataset['OPERON'] = [operon[:i]+t+operon[j:] for t in terminators]
 dataset['TERMINATOR.START'] = i
 dataset['TERMINATOR.END'] = [i+len(t)-1 for t in terminators]
 
-DB += dataset # add dataset to DataBase
+DB.stage(dataset) # add dataset to DataBase with the next commit
 
 
 '''
@@ -110,6 +110,9 @@ dataset['OPERON'] = [operon[:i]+t+operon[j:] for t in terminators]
 dataset['TERMINATOR.START'] = i
 dataset['TERMINATOR.END'] = [i+len(t)-1 for t in terminators]
 
-DB += dataset
+DB.stage(dataset)
+
+# concatenate the staged datasets once
+DB.commit(categories=['ORGANISM','DATASET'])
 
 DB.save('terminators',type='pickle')
\ No newline at end of file
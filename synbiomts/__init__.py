@@ -1,10 +1,11 @@
 # This file is a part of synbiomts
 __author__ = "Alexander C. Reis"
 __version__ = "1.0"
-__all__ = ['analyze','dbms','initdb','interface','stats','graphics','learn']
+__all__ = ['analyze','dbms','executors','initdb','interface','stats','graphics','learn']
 
 import analyze
 import dbms
+import executors
 import initdb
 import interface
 import stats
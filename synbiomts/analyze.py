@@ -6,26 +6,313 @@ Copyright 2017 Alexander C. Reis, Howard M. Salis, all rights reserved.
 """
 
 import os
-import copy_reg
-import types
+import time
+import signal
 import cPickle as pickle
-from itertools import product
 import multiprocessing as mp
 import scipy
 import numpy as np
 import pandas
 import shelve
+import hashlib
 import dbms
+import interface
+import executors
 import stats
 
-# Using copy_reg to allow the pickle module to instance methods
-# Replicates multiprocessing module's ForkingPickler
-def _reduce_method(m):
-    if m.im_self is None:
-        return getattr, (m.im_class, m.im_func.func_name)
+# Worker-resident state: the model container and the database records are
+# sent to each worker process once by _init_worker, so that a task only
+# needs to carry a model name and a row index.
+_worker = {}
+
+class TaskTimeout(Exception):
+    '''Raised in a worker when a model call runs longer than the task timeout.'''
+    pass
+
+def _alarm(signum,frame):
+    raise TaskTimeout("Model call exceeded the timeout of {} s.".format(_worker['timeout']))
+
+def _init_worker(models,records,verbose=False,timeout=None,retries=0):
+    '''Pool initializer; stores the models and database records in the worker.
+    records maps each model's tuple of required columns (interface.Container.add)
+    to a list of tuples of the values in those columns, one for each row.'''
+    _worker['models'] = models
+    _worker['records'] = records
+    _worker['verbose'] = verbose
+    _worker['timeout'] = timeout
+    _worker['retries'] = retries
+    # timeouts use SIGALRM, whose handler can only be set from the main thread of a
+    # process (signal.signal raises ValueError elsewhere); after a fork the forking
+    # thread is the main thread, so this includes workers that the pool forks from
+    # its handler thread to replace recycled ones (maxtasksperchild), although
+    # threading does not report them as running in the main thread
+    _worker.pop('sigalrm',None)
+    if timeout:
+        try:
+            _worker['sigalrm'] = signal.signal(signal.SIGALRM,_alarm)
+        except ValueError:
+            pass
+
+def _wrap(task):
+    ''' _wrap runs a model on a row of the worker's copy of the database;
+    this function requires a tuple input for Python's map() function.
+    Returns a (name,index,output,seconds,error) tuple so results can be reassembled
+    by row index and the runtime of the model call can be recorded. A model call
+    that raises an exception or times out is tried again up to retries times; if
+    it still fails, output is None and error is a dictionary describing the failure.
+
+    For batch models (see interface.Container.add_batch), index is a tuple of row
+    indexes, the model is called once with a list of values for each argument and
+    output is the model's dictionary of columns.'''
+
+    (name,indx) = task
+    model = _worker['models'][name]
+    rows = _worker['records'][model.columns]
+    if model.batch:
+        block = [rows[i] for i in indx]
+        kargs = {k: [row[j] for row in block] for j,k in enumerate(model.arguments)}
     else:
-        return getattr, (m.im_self, m.im_func.func_name)
-copy_reg.pickle(types.MethodType, _reduce_method)
+        kargs = dict(zip(model.arguments,rows[indx]))
+    timeout = _worker['timeout'] if 'sigalrm' in _worker else None
+
+    if _worker['verbose']:
+        fmt = "model={m:s}, row={i:s}, {kargs:s}"
+        print fmt.format(m=name,i=str(indx)[:40],kargs=str(kargs)[:80])
+
+    # Run model
+    start = time.time()
+    for attempt in xrange(1,_worker['retries']+2):
+        try:
+            if timeout: signal.setitimer(signal.ITIMER_REAL,timeout)
+            try:
+                output = model(**kargs)
+            finally:
+                if timeout: signal.setitimer(signal.ITIMER_REAL,0)
+            if model.batch and any(len(v) != len(indx) for v in output.itervalues()):
+                raise ValueError("Batch model {} returned columns of the wrong length.".format(name))
+            return (name,indx,output,time.time()-start,None)
+        except Exception as e:
+            error = {'ERROR': "{}: {}".format(type(e).__name__,e),'ATTEMPTS': attempt}
+    return (name,indx,None,time.time()-start,error)
+
+def _fit(job):
+    '''Runs a stats function for calc_stats; returns (key,(results,yError)).'''
+    (key,func,args) = job
+    return (key,func(*args))
+
+def _transform(values,scale,name):
+    '''Transform values to the linear, ln or log10 scale of a model's functional form.'''
+    if   scale == 'ln':     return np.log(values)
+    elif scale == 'log10':  return np.log10(values)
+    elif scale == 'linear': return values
+    else: raise Exception('Bad scale set for {}'.format(name))
+
+def _inverse(values,scale,name):
+    '''Inverse of _transform.'''
+    if   scale == 'ln':     return np.exp(values)
+    elif scale == 'log10':  return np.power(10,values)
+    elif scale == 'linear': return values
+    else: raise Exception('Bad scale set for {}'.format(name))
+
+
+class Checkpoint(object):
+    '''Append-only file of completed model predictions, used by ModelTest.predict
+    to resume a run that was interrupted. The file starts with a marker (MAGIC) and a
+    fingerprint of the database entries, followed by one pickled (model key, row index,
+    output) record for each completed task, where the key identifies the model and the
+    arguments it was given (see ModelTest.predict). Records are buffered and flushed
+    to disk (with fsync) every flush_every records; a record left incomplete by a crash
+    is discarded when the file is reopened. An existing file that is not a checkpoint
+    (e.g. a shelve of predictions from an older version) is never overwritten.'''
+
+    MAGIC = 'SYNBIOMTS-CHECKPOINT-1\n'
+
+    def __init__(self,filename,dbfingerprint,flush_every=100,resume=True):
+        assert flush_every > 0, "flush_every should be an int > 0"
+        self.filename = filename
+        self.flush_every = flush_every
+        self.records = {}
+        self._pending = 0
+
+        end = 0
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            with open(filename,'rb') as handle:
+                if handle.read(len(self.MAGIC)) != self.MAGIC:
+                    raise Exception("{} exists and is not a checkpoint file; remove it or "
+                                    "use another filename.".format(filename))
+                if resume:
+                    try:
+                        header = pickle.load(handle)
+                        end = handle.tell()
+                        if header != dbfingerprint:
+                            raise Exception("Checkpoint {} was written for a different database or filters; "
+                                            "use recalc=True to overwrite it.".format(filename))
+                        while True:
+                            (fp,indx,output) = pickle.load(handle)
+                            self.records[(fp,indx)] = output
+                            end = handle.tell()
+                    except (EOFError,ValueError,TypeError,pickle.UnpicklingError):
+                        pass
+
+        if end:
+            # drop any incomplete record at the end of the file (after a valid header)
+            self.handle = open(filename,'r+b')
+            self.handle.truncate(end)
+            self.handle.seek(end)
+        else:
+            self.handle = open(filename,'wb')
+            self.handle.write(self.MAGIC)
+            pickle.dump(dbfingerprint,self.handle,protocol=2)
+            self.flush()
+
+    def get(self,fp,indx):
+        '''Returns (True,output) if the task was completed in a previous run, else (False,None).'''
+        if (fp,indx) in self.records:
+            return (True,self.records[(fp,indx)])
+        return (False,None)
+
+    def append(self,fp,indx,output):
+        pickle.dump((fp,indx,output),self.handle,protocol=2)
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self._pending = 0
+
+    def close(self):
+        if not self.handle.closed:
+            self.flush()
+            self.handle.close()
+
+
+class CostModel(object):
+    '''Estimates the runtime of model calls to schedule the most expensive tasks
+    first. The cost of a task is the model's runtime per nucleotide times the length
+    of the sequence. Runtimes per nucleotide are learned from completed tasks and kept
+    in filename (if given) for later runs; until a model has been timed, its relative
+    cost is taken from the model's cost attribute (default 1.0), e.g.:
+
+        >>> EMOPEC.cost = 0.01
+        >>> models.add(EMOPEC)'''
+
+    def __init__(self,filename=None):
+        self.filename = filename
+        self.runtimes = {} # model fingerprint: (total seconds, total nucleotides)
+        if not filename is None and os.path.exists(filename):
+            with open(filename,'rb') as handle:
+                self.runtimes = pickle.load(handle)
+
+    def rate(self,model,fp):
+        '''Runtime per nucleotide of a model (in arbitrary units for untimed models).'''
+        if fp in self.runtimes:
+            (seconds,nts) = self.runtimes[fp]
+            return seconds/max(nts,1)
+        # untimed models are scaled to the mean timed rate
+        rates = [sec/max(nts,1) for (sec,nts) in self.runtimes.itervalues()]
+        prior = np.mean(rates) if rates else 1.0
+        return prior*getattr(model,'cost',1.0)
+
+    def record(self,fp,seqlen,seconds):
+        (total,nts) = self.runtimes.get(fp,(0.0,0))
+        self.runtimes[fp] = (total+seconds,nts+seqlen)
+
+    def save(self):
+        if not self.filename is None:
+            with open(self.filename,'wb') as handle:
+                pickle.dump(self.runtimes,handle,protocol=2)
+
+
+class Predictions(object):
+    '''Container of model predictions that keeps the database columns (base) once,
+    and the output columns of each model as a separate block aligned with the base
+    by index. A model's full pandas dataframe, the base columns (all of them if
+    add_data is True, else only the identifiers) followed by the model's columns,
+    is only built when it is requested with predictions[model]; it is then kept in
+    place of the block, so that changes to it are not lost. frame(model) and
+    column(model,label) read predictions without keeping a dataframe. Dataframes from
+    outside of the test system can be stored with predictions[name] = dataframe.
+    Predictions otherwise behaves as the dictionary of dataframes it replaces.'''
+
+    def __init__(self,base,identifiers,add_data=True):
+        self.base = base
+        self.identifiers = identifiers
+        self.add_data = add_data
+        self.blocks = {}
+        self.frames = {}
+
+    def __getitem__(self,name):
+        if not name in self.frames:
+            self.frames[name] = self.frame(name)
+            del self.blocks[name]
+        return self.frames[name]
+
+    def __setitem__(self,name,frame):
+        assert isinstance(frame,pandas.DataFrame), "Predictions should be a pandas dataframe."
+        self.blocks.pop(name,None)
+        self.frames[name] = frame
+
+    def __contains__(self,name):
+        return name in self.blocks or name in self.frames
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.blocks) + len(self.frames)
+
+    def keys(self):
+        return self.blocks.keys() + self.frames.keys()
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name,self[name]) for name in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def get(self,name,default=None):
+        return self[name] if name in self else default
+
+    def frame(self,name):
+        '''Returns a model's dataframe; unlike predictions[name], a dataframe built
+        from the model's block is not kept, so changes to it are lost.'''
+        if name in self.frames:
+            return self.frames[name]
+        base = self.base if self.add_data else self.base[self.identifiers]
+        return pandas.concat([base,self.blocks[name]],axis=1)
+
+    def add(self,name,block):
+        '''Store the output columns of a model (a dataframe indexed like the base).'''
+        self.frames.pop(name,None)
+        self.blocks[name] = block
+
+    def column(self,name,label):
+        '''Returns a column of a model's predictions without building its dataframe.'''
+        if name in self.frames:
+            if label in self.frames[name] or not self.frames[name].index.equals(self.base.index):
+                return self.frames[name][label]
+            # a model's dataframe without the database columns (add_data is False)
+            return self.base[label]
+        if label in self.blocks[name]:
+            return self.blocks[name][label]
+        return self.base[label]
+
+    def set_column(self,name,label,values):
+        if name in self.frames:
+            self.frames[name][label] = values
+        else:
+            self.blocks[name][label] = values
 
 
 class ModelTest(object):
@@ -33,7 +320,9 @@ class ModelTest(object):
     # identifiers is used to uniquely identify sequence entries
     identifiers = ["SEQUENCE","SUBGROUP"]
 
-    def __init__(self,models,dbfilename,filters={},recalc=False,add_data=True,nprocesses=(mp.cpu_count()-1),verbose=False):
+    def __init__(self,models,dbfilename,filters={},recalc=False,add_data=True,nprocesses=(mp.cpu_count()-1),verbose=False,
+                 chunksize=None,executor=None,batchsize=1000,timeout=None,retries=0,maxtasksperchild=None,
+                 cache=None,checkpoint_every=100,costfile=None,nbootstrap=0):
         '''Inputs:
         models (interface.Container)  = see interface.Container
         dbfilename (string)           = filename of the geneticsystems database
@@ -41,6 +330,32 @@ class ModelTest(object):
         nprocesses (int)              = number of processes to use with
                                         multiprocessing if 1, ModelTest
                                         does not use multiprocessing
+        chunksize (int)               = number of tasks sent to a worker process
+                                        at a time; if None, chosen from the number
+                                        of tasks and processes (as in Pool.map)
+        executor (object)             = if not None, runs the model predictions instead
+                                        of nprocesses and chunksize; one of
+                                        executors.SerialExecutor, PoolExecutor or
+                                        RemoteExecutor (to share a run between hosts)
+        batchsize (int)               = number of database entries given to a batch model
+                                        (interface.Container.add_batch) in one call
+        timeout (float)               = if not None, seconds after which a model call
+                                        is interrupted (with SIGALRM, when the model
+                                        returns control to Python) and counted as failed
+        retries (int)                 = number of times a failed model call is retried;
+                                        calls that still fail are recorded in self.errors
+        maxtasksperchild (int)        = if not None, worker processes of the default
+                                        pool are replaced after this many tasks
+        cache (interface.PredictionCache) = if not None, model predictions are
+                                        looked up in and saved to this cache
+        checkpoint_every (int)        = number of completed predictions between
+                                        flushes of the checkpoint file to disk
+        costfile (string)             = if not None, model runtimes are saved to and
+                                        loaded from this file to schedule the most
+                                        expensive predictions first (see CostModel)
+        nbootstrap (int)              = if > 0, number of bootstrap resamples used by
+                                        calc_stats to add 95% confidence intervals
+                                        ("<statistic> CI.low/CI.high") to self.statistics
         recalc (bool)                 = boolean to tell the testsystem
                                         to recalcualte model predictions
                                         on existing datasets
@@ -53,16 +368,37 @@ class ModelTest(object):
         assert isinstance(recalc,bool),   "recalc should be boolean"
         assert isinstance(add_data,bool), "add_data should be boolean"
         assert isinstance(filters,dict),  "filters should be a dictionary"
+        if not chunksize is None:
+            assert chunksize > 0,         "chunksize should be an int > 0"
+        if not timeout is None:
+            assert timeout > 0,           "timeout should be a number of seconds > 0"
+        assert retries >= 0,              "retries should be an int >= 0"
+        assert batchsize > 0,             "batchsize should be an int > 0"
+        assert checkpoint_every > 0,      "checkpoint_every should be an int > 0"
+        assert nbootstrap >= 0,           "nbootstrap should be an int >= 0"
 
         self.models      = models
         self.dbfilename  = dbfilename
         self.recalc      = recalc
         self.add_data    = add_data
         self.nprocesses  = nprocesses
+        self.chunksize   = chunksize
+        if executor is None:
+            if nprocesses > 1: executor = executors.PoolExecutor(nprocesses,chunksize,maxtasksperchild)
+            else:              executor = executors.SerialExecutor()
+        self.executor    = executor
+        self.batchsize   = batchsize
+        self.timeout     = timeout
+        self.retries     = retries
+        self.cache       = cache
+        self.checkpoint_every = checkpoint_every
+        self.costs       = CostModel(costfile)
+        self.nbootstrap  = nbootstrap
         self.verbose     = verbose
         self.filters     = filters
-        self.predictions = {}
+        self.predictions = Predictions(pandas.DataFrame(),self.identifiers,add_data)
         self.statistics  = {}
+        self.errors      = pandas.DataFrame()
 
         # import sequences from genetic systems database
         # based on specified dbfilename and filters
@@ -71,7 +407,7 @@ class ModelTest(object):
     def run(self,calcsFilename=None,statsFilename=None):
         '''Use run to (1) run model calculations and (2) model statistics
         Inputs:
-        calcsFilename (str) = If not None, saves model predictions to a shelve persistance object
+        calcsFilename (str) = If not None, checkpoints model predictions to this file (see predict)
         statsFilename (str) = If not None, saves model statistics to a shelve persistance object'''
 
         self.predict(calcsFilename)
@@ -80,110 +416,218 @@ class ModelTest(object):
     def predict(self,filename=None):
         '''Use predict to (1) run model calculations without model statistics
         Inputs:
-        filename (str) = If not None, saves model predictions to a shelve persistance object'''
-
-        db = self.database
+        filename (str) = If not None, completed model predictions are appended to this
+                         checkpoint file as they finish; if self.recalc is False, a run
+                         resumes from the predictions already saved in the file
 
-        # Remove sequences that have already been calculated if self.recalc is False,
-        # convert pandas dataframe into entries, a list of records (dictionaries)
-        # then bundle these entries with the models that are available
-        n_entries = []
-        if (not self.recalc) and (not filename is None):
-            bundles = []
-            d = shelve.open(filename)
-            for model in self.models.available:
-                if model in d.keys():
-                    kargs = {i: d[model][i] for i in self.identifiers}
-                    db.remove_data(kargs,ordered=True)
-                    dict_list = db.get_entries()
-                    n_entries.append((model,len(dict_list)))
-                    bundles += [(model,entry) for entry in dict_list]
-                else:
-                    dict_list = db.get_entries()
-                    bundles += product([model],dict_list)
-                    n_entries.append((model,len(dict_list)))
-            d.close()
-        else:
-            dict_list = db.get_entries()
-            bundles = product(self.models.available,dict_list)
-            n = len(dict_list)
-            n_entries = [(m,n) for m in self.models.available]
-
-        # Call multiprocessing (or MPI) to run model predictions
-        if self.nprocesses > 1:
-            pool = mp.Pool(processes=self.nprocesses)
-            output = pool.map(self._wrap,bundles)
-            pool.close()
-            pool.join()
-        else:
-            output = [self._wrap(bundle) for bundle in bundles]
+        The argument records of all rows (one list of tuples for each set of model
+        arguments) are built from DataBase.records before any task is dispatched and
+        kept in every worker, so the memory they use grows with the database; only
+        the predictions are streamed back as they are completed.'''
 
-        # Convert model predictions (list of dictionaries) to pandas dataframes
+        db = self.database
         db.data.reset_index(drop=True, inplace=True)
-        total = 0
-        for model,n in n_entries:
-            modelcalcs = pandas.DataFrame(output[total:total+n])
-            if self.add_data:
-                dfsave = pandas.concat([db.data, modelcalcs], axis=1)
-            else:
-                dfsave = pandas.concat([db.data[self.identifiers], modelcalcs], axis=1)
-            self.predictions[model] = dfsave
-            total += n
-
-
-
-    def _wrap(self,bundle):
-        ''' _wrap interprets the inputs of the interface.Model and pulls those values
-        from the database; this method requires a tuple input for Python's map() function.'''
-
-        (name,entry) = bundle
-        # entry = {'ORGANISM':"Escherichia coli",'SEQUENCE':"ACTCGATCTT",...}
-
-        # dev notes
-        #('ACTGTAC',) # args
-        #{'organism': 'E. coli', 'temp': 37.0} # keywords
-        #['sequence', 'organism', 'temp', 'startpos'] # variables
-
-        # Remove args and keywords from variables list
-        vrs = self.models[name].variables[len(self.models[name].args):]
-        vrs = [k for k in vrs[:] if k not in self.models[name].keywords.keys()]
-
-        # Exception handling when data is not available
-        if any(k.upper() not in entry.keys() for k in vrs):
-            err = "One of {}'s arguments is not in the database.".format(name)
-            print "Model requested arguments: " + str(vrs)
-            print "Database available values: " + str(entry.keys())
-            raise KeyError(err)
-        else:
-            kargs = {k: entry[k.upper()] for k in vrs}
 
+        # Project the database onto the columns required by each model: records are
+        # lists of tuples (one per row) of the values in those columns, which are sent
+        # once to each worker process; models requiring the same columns share records
+        # (DataBase.records is read to the end here, as the workers need all rows)
+        data = db.data
+        records = {}
+        for model in self.models.available:
+            columns = self.models[model].columns
+            if any(c not in data.keys() for c in columns):
+                err = "One of {}'s arguments is not in the database.".format(model)
+                print "Model requested arguments: " + str(self.models[model].arguments)
+                print "Database available values: " + str(list(data.keys()))
+                raise KeyError(err)
+            if not columns in records:
+                records[columns] = list(db.records(columns))
+        indexes = range(len(data))
+        tasks = [(model,indx) for model in self.models.available for indx in indexes]
+        outputs = {model: {} for model in self.models.available}
+        fingerprints = {model: interface.fingerprint(self.models[model]) for model in self.models.available}
+
+        # Resume from predictions saved in the checkpoint file unless self.recalc is True
+        # Saved predictions are keyed by the model's fingerprint and a hash of the
+        # argument records sent to it, so that a change to any of the model's
+        # arguments in the database (not only the identifiers) invalidates them
+        if not filename is None:
+            h = hashlib.sha1()
+            for identifiers in db.records(self.identifiers):
+                h.update(repr(identifiers))
+            checkpoint = Checkpoint(filename,h.hexdigest(),self.checkpoint_every,resume=not self.recalc)
+            hashes = {}
+            for columns,rows in records.iteritems():
+                h = hashlib.sha1(repr(columns))
+                for row in rows:
+                    h.update(repr(row))
+                hashes[columns] = h.hexdigest()
+            resumekeys = {model: hashlib.sha1(fingerprints[model] + hashes[self.models[model].columns]).hexdigest()
+                          for model in self.models.available}
+            remaining = []
+            for (model,indx) in tasks:
+                (found,output) = checkpoint.get(resumekeys[model],indx)
+                if found:
+                    outputs[model][indx] = output
+                else:
+                    remaining.append((model,indx))
+            if self.verbose:
+                print "Resuming from {}: {} of {} predictions completed.".format(filename,len(tasks)-len(remaining),len(tasks))
+            tasks = remaining
+
+        # Collapse tasks that call a model with identical arguments (e.g. the same
+        # sequence in several subgroups or datasets); each unique call is run once,
+        # on its first row, and its output is copied to all of its rows
+        groups = {}
+        for (model,indx) in tasks:
+            unique = (model,records[self.models[model].columns][indx])
+            groups.setdefault(unique,[]).append(indx)
+        duplicates = {}
+        tasks = []
+        for (model,_),indxs in groups.iteritems():
+            tasks.append((model,indxs[0]))
+            duplicates[(model,indxs[0])] = indxs
         if self.verbose:
-            fmt = "model={m:s}, SUBGROUP={sbgrp:s}, seq={seq:s}..."
-            print fmt.format(m=name,sbgrp=entry['SUBGROUP'],seq=entry['SEQUENCE'][:50])
-
-        # Run model
-        return self.models[name](**kargs)
+            print "{} unique model calls for {} predictions.".format(len(tasks),sum(map(len,duplicates.values())))
+
+        def store(model,indx,output):
+            for i in duplicates[(model,indx)]:
+                outputs[model][i] = output
+                if not filename is None:
+                    checkpoint.append(resumekeys[model],i,output)
+
+        # Look up predictions in the cache; only the misses are sent to the workers
+        if not self.cache is None:
+            keys = {}
+            misses = []
+            for (model,indx) in tasks:
+                kargs = dict(zip(self.models[model].arguments,records[self.models[model].columns][indx]))
+                key = self.cache.key(self.models[model],kargs)
+                (found,output) = self.cache.get(key)
+                if found:
+                    store(model,indx,output)
+                else:
+                    keys[(model,indx)] = key
+                    misses.append((model,indx))
+            tasks = misses
+
+        # Batch models are called once for each block of (up to self.batchsize) rows
+        batches = {}
+        for (model,indx) in tasks:
+            if self.models[model].batch:
+                batches.setdefault(model,[]).append(indx)
+        tasks = [(model,indx) for (model,indx) in tasks if not self.models[model].batch]
+        for model,indxs in batches.iteritems():
+            tasks += [(model,tuple(indxs[i:i+self.batchsize])) for i in xrange(0,len(indxs),self.batchsize)]
+
+        # Schedule the most expensive tasks first, so that no worker is left
+        # running a slow model call while the others are idle at the end of the run
+        rates = {model: self.costs.rate(self.models[model],fingerprints[model]) for model in self.models.available}
+        sequences = data['SEQUENCE'].tolist()
+        def seqlen(indx):
+            if isinstance(indx,tuple): return sum(len(sequences[i]) for i in indx)
+            return len(sequences[indx])
+        tasks.sort(key=lambda (model,indx): rates[model]*seqlen(indx),reverse=True)
+
+        # Call multiprocessing (or MPI) to run model predictions; results are streamed
+        # back in completion order and drained into per-model records keyed by row index
+        # Failed model calls are recorded as error rows (and not saved to the
+        # checkpoint or cache, so that they are tried again in a later run)
+        errors = []
+        try:
+            for (model,block,output,seconds,error) in self._dispatch(tasks,records):
+                self.costs.record(fingerprints[model],seqlen(block),seconds)
+                if not isinstance(block,tuple):
+                    (block,output) = ((block,),[output])
+                elif error is None:
+                    # split the columns returned by a batch model into rows
+                    columns = output.keys()
+                    output = [dict(zip(columns,values)) for values in zip(*output.values())] or [{}]*len(block)
+                for j,indx in enumerate(block):
+                    if not error is None:
+                        for i in duplicates[(model,indx)]:
+                            outputs[model][i] = {}
+                            errors.append(dict(error,MODEL=model,ROW=i))
+                        continue
+                    store(model,indx,output[j])
+                    if not self.cache is None:
+                        self.cache.put(keys[(model,indx)],output[j])
+        finally:
+            if not filename is None:
+                checkpoint.close()
+            self.costs.save()
+
+        if self.verbose and not self.cache is None:
+            print self.cache
+
+        self.errors = pandas.DataFrame(errors,columns=['MODEL','ROW','ERROR','ATTEMPTS'])
+        for i in self.identifiers:
+            self.errors[i] = data[i].values[self.errors['ROW'].values.astype(int)]
+        if self.verbose and errors:
+            print "{} model calls failed; see ModelTest.errors.".format(len(errors))
+
+        # Convert model predictions (dictionaries keyed by row index) to blocks of columns
+        # stored alongside one shared copy of the database
+        if not self.predictions.base is data:
+            self.predictions = Predictions(data,self.identifiers,self.add_data)
+        for model in self.models.available:
+            modelcalcs = pandas.DataFrame([outputs[model].pop(i) for i in indexes],index=indexes)
+            self.predictions.add(model,modelcalcs)
+
+    def _dispatch(self,tasks,records):
+        ''' _dispatch runs _wrap on each (model,index) task with self.executor and yields
+        (model,index,output,seconds,error) tuples as soon as they are completed, in no
+        particular order. The models and database records are sent once to each worker
+        by the initializer.'''
+
+        initargs = (self.models,records,self.verbose,self.timeout,self.retries)
+        try:
+            for result in self.executor.imap_unordered(_wrap,tasks,_init_worker,initargs):
+                yield result
+        finally:
+            # the serial executor initializes this process as its worker
+            if 'sigalrm' in _worker:
+                signal.signal(signal.SIGALRM,_worker['sigalrm'])
+            _worker.clear()
 
     def _update_database(self):
         ''' _update_database is run on __init__ and anytime the database, datasets,
         or filters are updated with any of the following methods:
         add_datasets(), remove_datasets(), remove_filters().'''
 
-        try:
-            handle = open(self.dbfilename,'r')
-            database = pickle.load(handle)
-            handle.close()
-            assert isinstance(database,pandas.DataFrame)
-        except:
-            raise Exception("Database filename: {} is not valid.".format(self.dbfilename))
+        # A columnar database (see dbms.save_columns) is loaded lazily: only the
+        # columns used by the test and the rows that pass the filters are read
+        if os.path.isdir(self.dbfilename):
+            meta = dbms.load_metadata(self.dbfilename)
+            labels = meta['labels']
+            database = None
+        else:
+            try:
+                handle = open(self.dbfilename,'r')
+                database = pickle.load(handle)
+                handle.close()
+                if isinstance(database,dbms.DataBase): # e.g. written by initdb.py
+                    database = database.data
+                assert isinstance(database,pandas.DataFrame)
+            except:
+                raise Exception("Database filename: {} is not valid.".format(self.dbfilename))
+            labels = database.keys()
 
         for i in self.identifiers:
-            assert i in database.keys(), "{} isn't a database label.".format(i)
+            assert i in labels, "{} isn't a database label.".format(i)
 
         # dbms.get_indexes checks that filters are labels in database
         # This code block code be removed if dbms.get_indexes gets no values
         if "DATASET" in self.filters:
-            listed = database["DATASET"].cat.categories
+            if database is None and "DATASET" in meta['categories']:
+                listed = meta['categories']["DATASET"]
+            elif database is None:
+                listed = dbms.load_columns(self.dbfilename,["DATASET"])["DATASET"].unique()
+            elif pandas.api.types.is_categorical_dtype(database["DATASET"]):
+                listed = database["DATASET"].cat.categories
+            else:
+                listed = database["DATASET"].unique()
             unlisted = [x for x in self.filters["DATASET"] if x not in listed]
             if unlisted:
                 error = "These datasets are unlisted: " + ", ".join(unlisted)
@@ -193,82 +637,119 @@ class ModelTest(object):
         # if self.filters:
         #     database.filter(self.filters,False)
 
-        if self.filters:
-            for key,valuelist in self.filters.iteritems():
-                database = database[database[key].isin(valuelist)].reset_index()
+        # Filters are combined into one row selection, cached by database file and
+        # filters for later ModelTests (see dbms.select)
+        if database is None:
+            database = dbms.load_columns(self.dbfilename,self._columns(labels),self.filters)
+            if self.filters:
+                database = database.reset_index()
+
+        elif self.filters:
+            rows = dbms.select(database,self.filters,dbms.database_key(self.dbfilename))
+            database = database.iloc[rows].reset_index()
 
         self.database = dbms.DataBase(database)
 
+        # dataset properties (see _dataset_properties) depend on the database and filters
+        self._properties = {}
+
+    def _columns(self,labels):
+        '''Returns the database labels (in database order) used by the test: all of
+        them if add_data is True, else the identifiers, the columns of the models'
+        arguments and functional forms, the columns used by calc_stats and filters.'''
+        if self.add_data:
+            return list(labels)
+        used = set(self.identifiers + ["SEQUENCE","STARTPOS"] + self.filters.keys())
+        for m in self.models.available:
+            model = self.models[m]
+            used.update(model.columns)
+            if model.set:
+                used.update([model.x,model.y,model.std])
+        return [label for label in labels if label in used]
+
     def calc_stats(self,filename=None):
         ''' calc_stats runs stats.linear_complete for models with defined 
         functional forms; calc_stats runs the statistics on each of the subgroups
         as well as the full dataset defined by the database any any provided filters.
+        The (model,subgroup) fits are independent and are run with self.executor;
+        results are collected by (model,subgroup), so the statistics do not depend
+        on the executor or on the order in which fits complete. With nbootstrap > 0,
+        bootstrap resamples are seeded by subgroup, so confidence intervals are
+        reproducible as well.
         Inputs:
         filename = If not None, saves model statistics to a shelve persistance object'''
 
+        base = self.predictions.base
+        (subgroups,slices,entropies) = self._dataset_properties()
+        # Collect the fits to run on each (model,subgroup) with at least two valid predictions
+        arrays = {}
+        jobs = []
         for m in self.models.available:
-            df = self.predictions[m]
-            allError = np.nan*np.ones(len(df))
-            allPredicted = np.nan*np.ones(len(df))
-            entries = []
+            x = np.asarray(self.predictions.column(m,self.models[m].x),dtype=np.float64)
+            y = np.asarray(self.predictions.column(m,self.models[m].y),dtype=np.float64)
+            std = np.asarray(self.predictions.column(m,self.models[m].std),dtype=np.float64)
+
+            # filter out no-prediction sequences (nan and inf values) for all rows at once,
+            # and transform the predictor once to calculate yPredicted
+            invalid = ~np.isfinite(x) + (x == 0.0)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                xt = _transform(x,self.models[m].xScale,m)
+            arrays[m] = (y,std,invalid,xt)
+
+            for k,indx in enumerate(slices):
+                valid = indx[~invalid[indx]]
+                if len(valid) >= 2:
+                    context = self._context(k,valid,m)
+                    args = (x[valid],None,None,self.models[m].xScale,self.models[m].yScale,self.models[m].a1,None,
+                            self.nbootstrap,k,context)
+                    jobs.append(((m,k),stats.linear_complete,args))
+        fits = dict(self.executor.imap_unordered(_fit,jobs))
+
+        # Predict y from the fits of each subgroup and collect the fits on ALL data
+        jobs = []
+        predicted = {}
+        for m in self.models.available:
+            (y,std,invalid,xt) = arrays[m]
             yScale = self.models[m].yScale
-            xScale = self.models[m].xScale
-
-            for subgroup in df["SUBGROUP"].unique():
-
-                # Extract subgroup data & predictions
-                indx = np.array(df["SUBGROUP"] == subgroup)
-                x = np.array(df[self.models[m].x][indx])
-                y = np.array(df[self.models[m].y][indx])
-                std = np.array(df[self.models[m].std][indx])
+            allError = np.nan*np.ones(len(y))
+            allPredicted = np.nan*np.ones(len(y))
+
+            for k,indx in enumerate(slices):
+                if (m,k) in fits:
+                    data,yError = fits[(m,k)]
+                    allError[indx[~invalid[indx]]] = yError
+                    allPredicted[indx] = _inverse(data['slope']*xt[indx] + data['intercept'],yScale,m)
+            predicted[m] = (allPredicted,allError)
+
+            invalid = ~np.isfinite(allPredicted) + (allPredicted == 0.0)
+            if (len(allPredicted) - np.sum(invalid) > 1):
+                context = self._context("ALL",np.flatnonzero(~invalid),m)
+                args = (allPredicted[~invalid],None,None,yScale,yScale,None,self.nbootstrap,len(slices),context)
+                jobs.append(((m,"ALL"),stats.linear_simple,args))
+        fits.update(self.executor.imap_unordered(_fit,jobs))
+
+        # Assemble the statistics of each model in subgroup order, followed by ALL
+        for m in self.models.available:
+            (y,std,invalid,xt) = arrays[m]
+            (allPredicted,allError) = predicted[m]
+            entries = []
 
-                # filter out no-prediction sequences (nan and inf values)
-                setsize = len(x)
-                invalid = np.isnan(x) + np.isinf(x) + (x == 0.0)
-                count_invalid = np.sum(invalid)
-                x_valid = x[~invalid]
-                y_valid = y[~invalid]
-                std_valid = std[~invalid]
+            for k,subgroup in enumerate(subgroups):
+                indx = slices[k]
 
                 # Insufficient number of sequences in dataset or
                 # model was unable to predict more than two sequences
-                if (setsize - count_invalid < 2):
+                if (m,k) in fits:
+                    data = dict(fits[(m,k)][0])
+                    data["valid dataset"] = True
+                else:
                     data = {}
                     data["valid dataset"] = False
-                    yErrorAll = np.nan*np.ones(setsize)
-                    yPredicted = np.nan*np.ones(setsize)
-                    
-                else:
-                    # Run statistics and information theory calcs
-                    # At least two data points required to run stats
-                    data,yError = stats.linear_complete(x_valid,y_valid,std_valid,xScale,yScale,self.models[m].a1)
-                    data["valid dataset"] = True
-
-                    # "place" yError into correct size array
-                    yErrorAll = np.nan*np.ones(setsize)
-                    np.place(yErrorAll,~invalid,yError)
-
-                    # Calculate yPredicted based on linear model fit
-                    if   xScale == 'ln':     x = np.log(x)
-                    elif xScale == 'log10':  x = np.log10(x)
-                    elif xScale == 'linear': pass
-                    else: raise Exception('Bad xScale set for {}'.format(m))
-
-                    yPredicted = data['slope']*x + data['intercept']
-                    if   yScale == 'ln':     yPredicted = np.exp(yPredicted)
-                    elif yScale == 'log10':  yPredicted = np.power(10,yPredicted)
-                    elif yScale == 'linear': pass
-                    else: raise Exception('Bad yScale set for {}'.format(m))
-
-                    # Add yError and yPredicted to model predictions
-                    allError[indx] = yErrorAll
-                    allPredicted[indx] = yPredicted
                     
                 # Define subgroup, number of non-predicted sequence, and sequence entropy
                 data["SUBGROUP"] = subgroup
-                data["Count.Invalid"] = count_invalid
-                data["Sequence entropy"],_ = stats.sequence_entropy(df["SEQUENCE"][indx],\
-                                                          positions=df["STARTPOS"][indx])
+                data["Count.Invalid"] = np.sum(invalid[indx])
+                data["Sequence entropy"] = entropies[k]
                 
                 if data["valid dataset"]:
                     data["MC"] = data["Sequence entropy"]*(data["N-states"]-1)*data["RIG"]
@@ -278,29 +759,17 @@ class ModelTest(object):
                 # Append data to entries
                 entries.append(data)
 
-            # Calculate statistics for model {m} on ALL data
-            x = allPredicted
-            y = np.array(df[self.models[m].y])
-            std = np.array(df[self.models[m].std])
-
-            setsize = len(x)
-            invalid = np.isnan(x) + np.isinf(x) + (x == 0.0)
-            count_invalid = np.sum(invalid)
-            x_valid = x[~invalid]
-            y_valid = y[~invalid]
-            std_valid = std[~invalid]
-                
-            if (setsize - count_invalid > 1):
-                data,_ = stats.linear_simple(x_valid,y_valid,std_valid,xScale=yScale,yScale=yScale)
+            # Statistics for model {m} on ALL data
+            if (m,"ALL") in fits:
+                data = dict(fits[(m,"ALL")][0])
                 data["valid dataset"] = True
             else:
                 data = {}
                 data["valid dataset"] = False
 
             data["SUBGROUP"] = "ALL"
-            data["Count.Nan"] = count_invalid
-            data["Sequence entropy"],_ = stats.sequence_entropy(df["SEQUENCE"],\
-                                                      positions=df["STARTPOS"])
+            data["Count.Nan"] = np.sum(~np.isfinite(allPredicted) + (allPredicted == 0.0))
+            data["Sequence entropy"] = entropies["ALL"]
             if data["valid dataset"]:
                 data["MC"] = data["Sequence entropy"]*(data["N-states"]-1)*data["RIG"]
                 print m, data["MC"]
@@ -309,21 +778,64 @@ class ModelTest(object):
             entries.append(data)
 
             self.statistics[m] = pandas.DataFrame(entries)
-            self.predictions[m]['yPredicted'] = pandas.Series(allPredicted, index=df.index)
-            self.predictions[m]['yError'] = pandas.Series(allError, index=df.index)
+            self.predictions.set_column(m,'yPredicted',pandas.Series(allPredicted, index=base.index))
+            self.predictions.set_column(m,'yError',pandas.Series(allError, index=base.index))
 
         # write statistics to shelve if filename given
         if not filename is None:
             pass
     
-    def compare2models(self,modelNames=[],modelCalcs=[]):
+    def _dataset_properties(self):
+        '''Returns the properties of the database used by the statistics of every
+        model, computed once per database and filters (see _update_database):
+        subgroups (array) = subgroups in order of first appearance
+        slices (list)     = row indexes of each subgroup
+        entropies (dict)  = sequence entropy of each subgroup (by position) and "ALL"'''
+
+        if not "subgroups" in self._properties:
+            base = self.predictions.base
+            sequences = np.asarray(base["SEQUENCE"])
+            startpos = np.asarray(base["STARTPOS"])
+
+            # Group rows by SUBGROUP: order sorts the rows by subgroup (keeping the row
+            # order within each subgroup), so that each subgroup is a contiguous slice
+            codes,subgroups = pandas.factorize(base["SUBGROUP"])
+            order = np.argsort(codes,kind='mergesort')
+            bounds = np.searchsorted(codes[order],np.arange(len(subgroups)+1))
+            slices = [order[bounds[k]:bounds[k+1]] for k in xrange(len(subgroups))]
+
+            entropies = {}
+            for k,indx in enumerate(slices):
+                entropies[k],_ = stats.sequence_entropy(sequences[indx],positions=startpos[indx])
+            entropies["ALL"],_ = stats.sequence_entropy(sequences,positions=startpos)
+            self._properties["subgroups"] = (subgroups,slices,entropies)
+        return self._properties["subgroups"]
+
+    def _context(self,subgroup,rows,m):
+        '''Returns the stats.FitContext of a model's y and std columns in rows of
+        a subgroup (transformed measurements, states and histogram edges); cached
+        for all models that share y, std, yScale and the rows with valid predictions.'''
+        model = self.models[m]
+        key = ("context",subgroup,model.y,model.std,model.yScale,hashlib.sha1(rows.tostring()).hexdigest())
+        if not key in self._properties:
+            y = np.asarray(self.predictions.base[model.y],dtype=np.float64)[rows]
+            std = np.asarray(self.predictions.base[model.std],dtype=np.float64)[rows]
+            self._properties[key] = stats.FitContext(y,std,model.yScale)
+        return self._properties[key]
+
+    def compare2models(self,modelNames=[],modelCalcs=[],method="parametric",nperm=10000):
         '''Compares error distributions of two models by computing 
-        F-test and two-sample t-test for equal variance and means respectively.
+        F-test and two-sample t-test for equal variance and means respectively,
+        or permutation tests of the same hypotheses (see stats.permutation_counts),
+        which do not assume log-normal model errors.
         This method calls functions from the stats module.
         Input:
         modelNames (list) = one or two modelNames of model(s) that were predicted
         modelNames (list) = one or two model prediction dataframes
         *input should be one of either, or two of one only!
+        method (str)      = "parametric" (F-test & t-test) or "permutation"
+        nperm (int)       = number of permutations of the "permutation" tests, which
+                            are run in blocks with self.executor
         Output:
         IN BETA... currently prints a few values to bash
 
@@ -333,6 +845,9 @@ class ModelTest(object):
         assert isinstance(modelNames,list),error
         error = "Make sure to provide a list for modelCalcs for compare2models!"
         assert isinstance(modelCalcs,list),error
+        error = "method should be 'parametric' or 'permutation', not {}".format(method)
+        assert method in ("parametric","permutation"),error
+        assert nperm > 0, "nperm should be an int > 0"
         
         # Compare to internal models just run with the test system
         if len(modelNames) == 2:
@@ -367,14 +882,11 @@ class ModelTest(object):
                 is {} which exceeds 2.".format(len(modelNames)+len(modelCalcs)))
 
         # Let's calculate the F-test and the t-tests for these two model error distributions
-        x = self.predictions[modelNames[0]]['yError']
-        y = self.predictions[modelNames[1]]['yError']
+        x = self.predictions.column(modelNames[0],'yError')
+        y = self.predictions.column(modelNames[1],'yError')
         x = x[~np.isnan(x)]
         y = y[~np.isnan(y)]
 
-        (_,F,F_pval) = stats.vartest2(x,y,logNormal=True,test="F")
-        (_,t,t_pval) = stats.ttest2(x,y)
-        
         R2_1 = list(self.statistics[modelNames[0]]['Pearson R-squared'])[-1]
         R2_2= list(self.statistics[modelNames[1]]['Pearson R-squared'])[-1]
         mean1 = np.mean(x)
@@ -388,11 +900,33 @@ class ModelTest(object):
                 'mean1': mean1,
                 'mean2': mean2,
                 'var1': var1,
-                'var2': var2,
+                'var2': var2}
+
+        if method == "parametric":
+            (_,F,F_pval) = stats.vartest2(x,y,logNormal=True,test="F")
+            (_,t,t_pval) = stats.ttest2(x,y)
+            output.update({
                 'F-statistic': F,
                 'pval(F)': F_pval,
                 't-statistic': t,
-                'pval(t)': t_pval}
+                'pval(t)': t_pval})
+
+        else:
+            # Blocks of permutations are independent (seeded by block), so the
+            # p-values do not depend on the executor
+            blocksize = 1000
+            jobs = [(i,stats.permutation_counts,(x,y,min(blocksize,nperm-start),True,i))
+                    for i,start in enumerate(xrange(0,nperm,blocksize))]
+            counts = np.zeros(2,dtype=np.int64)
+            for _,(S,blockcounts) in self.executor.imap_unordered(_fit,jobs):
+                counts += blockcounts
+            pvalue = (counts + 1)/(nperm + 1.0)
+            output.update({
+                'var-statistic': S[0],
+                'pval(var)': pvalue[0],
+                'mean-statistic': S[1],
+                'pval(mean)': pvalue[1],
+                'nperm': nperm})
 
         return output
 
@@ -405,7 +939,7 @@ class ModelTest(object):
 
         d = shelve.open(filename)
         if not d: # if empty
-            d.update(self.predictions)
+            d.update({model: self.predictions.frame(model) for model in self.predictions.keys()})
         else:
             for model in self.models.available:
                 pass
@@ -442,10 +976,10 @@ class ModelTest(object):
         writer = pandas.ExcelWriter(fn)
         if predictColumns:
             for model in models:
-                self.predictions[model].to_excel(writer,sheet_name=model,columns=predictColumns)
+                self.predictions.frame(model).to_excel(writer,sheet_name=model,columns=predictColumns)
         else:
             for model in models:
-                self.predictions[model].to_excel(writer,sheet_name=model)
+                self.predictions.frame(model).to_excel(writer,sheet_name=model)
             
         if statsColumns:        
             for model in models:
@@ -5,30 +5,245 @@ Copyright 2017 Alexander C. Reis, Howard M. Salis, all rights reserved.
 
 """
 
+import os
+import collections
 import cPickle as pickle
+import numpy as np
 import pandas as pd
 
 '''Load a database from file, creates and returns a DataBase instance
-Inputs: filename (string) :: the filename with the extension
+Inputs: filename (string) :: the filename with the extension, or the directory
+                             of a columnar database (see save_columns)
+        columns (list)    :: if not None, the labels of the columns to load
+        filters (dict)    :: if not None, keys=database label, values=a list of
+                             values; only rows matching all filters are loaded
 Output: DB (DataBase)     :: a DataBase instance with data from filename'''
-def load(filename):
-    
-    if filename.endswith('.p'):
+def load(filename,columns=None,filters=None):
+
+    # columnar databases load only the requested columns and rows
+    if os.path.isdir(filename):
+        return DataBase(load_columns(filename,columns,filters))
+
+    # pickled DataFrame, or DataBase (e.g. geneticsystems.db written by initdb.py)
+    if filename.endswith('.p') or filename.endswith('.db'):
         with open(filename,'rb') as handle:
             data = pickle.load(handle)
+        if isinstance(data,DataBase):
+            data = data.data
 
     # load from 
     elif filename.endswith('.csv'):
         data = pd.read_csv(filename)
 
     else:
-        raise Exception('Filename, {}, should be a pickled file (.p) or a csv (.csv)'.format(filename))
+        raise Exception('Filename, {}, should be a pickled file (.p or .db) or a csv (.csv)'.format(filename))
+
+    if filters:
+        data = data[data[filters.keys()].isin(filters).all(1)]
+    if not columns is None:
+        data = data[columns]
 
     DB = DataBase(data)
     return DB
 
 
+'''Columnar database format: a directory with one file per column and a pickled
+metadata file (meta.p) with the labels, kinds and categories of the columns.
+    numeric columns     :: .npy arrays, memory-mapped when loaded
+    categorical columns :: .npy arrays of category codes; the categories are kept
+                           in the metadata
+    string columns      :: the concatenated strings as a .npy array of bytes and a
+                           .npy array of their offsets, both memory-mapped
+    other columns       :: pickled lists of values
+so that loading a few columns of a subset of rows only reads those from disk.'''
+_METAFILE = 'meta.p'
+
+'''Save a DataFrame as a columnar database
+Inputs: data (DataFrame) :: data to save
+        path (string)    :: directory of the columnar database (created if needed)'''
+def save_columns(data,path):
+
+    if os.path.exists(path) and not os.path.isdir(path):
+        raise Exception('{} is a file; choose another directory name for the columnar database.'.format(path))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    meta = {'nrows': len(data), 'labels': list(data.columns), 'kinds': {},
+            'files': {}, 'categories': {}, 'ordered': {}, 'index': None}
+    if not data.index.equals(pd.RangeIndex(len(data))):
+        meta['index'] = data.index
+
+    for i,label in enumerate(data.columns):
+        column = data[label]
+        name = os.path.join(path,'c{}'.format(i))
+        meta['files'][label] = 'c{}'.format(i)
+
+        if pd.api.types.is_categorical_dtype(column):
+            meta['kinds'][label] = 'category'
+            meta['categories'][label] = list(column.cat.categories)
+            meta['ordered'][label] = column.cat.ordered
+            np.save(name+'.npy',column.cat.codes.values)
+
+        elif column.dtype.kind in 'biufcmM':
+            meta['kinds'][label] = 'numeric'
+            np.save(name+'.npy',column.values)
+
+        elif all(isinstance(value,str) for value in column.values):
+            meta['kinds'][label] = 'string'
+            lengths = np.array([len(value) for value in column.values],dtype=np.int64)
+            offsets = np.concatenate(([0],np.cumsum(lengths)))
+            np.save(name+'.npy',np.array(bytearray("".join(column.values)),dtype=np.uint8))
+            np.save(name+'.offsets.npy',offsets)
+
+        else:
+            meta['kinds'][label] = 'object'
+            with open(name+'.p','wb') as handle:
+                pickle.dump(column.tolist(),handle,protocol=2)
+
+    # write the metadata last, so that an interrupted save is not a valid database
+    with open(os.path.join(path,_METAFILE),'wb') as handle:
+        pickle.dump(meta,handle,protocol=2)
+
+'''Read the metadata of a columnar database (see save_columns)
+Inputs: path (string) :: directory of the columnar database
+Output: meta (dict)   :: with keys nrows, labels, kinds, files, categories, ordered, index'''
+def load_metadata(path):
+    try:
+        with open(os.path.join(path,_METAFILE),'rb') as handle:
+            return pickle.load(handle)
+    except (IOError,EOFError,pickle.UnpicklingError):
+        raise Exception('Directory, {}, is not a columnar database.'.format(path))
+
+'''Load columns and rows of a columnar database into a DataFrame
+Inputs: path (string)  :: directory of the columnar database (see save_columns)
+        columns (list) :: if not None, the labels of the columns to load (in order)
+        filters (dict) :: if not None, keys=database label, values=a list of values;
+                          only rows matching all filters are loaded
+        rows (array)   :: if not None, positions of the rows to load (before filters)
+Output: data (DataFrame) :: index labels of the loaded rows are kept'''
+def load_columns(path,columns=None,filters=None,rows=None):
+
+    meta = load_metadata(path)
+    if columns is None:
+        columns = meta['labels']
+    for label in list(columns) + (filters.keys() if filters else []):
+        assert label in meta['kinds'], "{} is not a label in the database".format(label)
+
+    def read(label,rows):
+        name = os.path.join(path,meta['files'][label])
+        kind = meta['kinds'][label]
+        if kind == 'object':
+            with open(name+'.p','rb') as handle:
+                values = pickle.load(handle)
+            if rows is None: return values
+            return [values[i] for i in rows]
+
+        array = np.load(name+'.npy',mmap_mode='r')
+        if kind == 'string':
+            offsets = np.load(name+'.offsets.npy',mmap_mode='r')
+            if rows is None: rows = xrange(meta['nrows'])
+            return [array[offsets[i]:offsets[i+1]].tostring() for i in rows]
+
+        array = np.array(array) if rows is None else array[rows]
+        if kind == 'category':
+            return pd.Categorical.from_codes(array,meta['categories'][label],meta['ordered'][label])
+        return array
+
+    # select rows with the filters first, reading only the filtered columns; the
+    # selection of all rows is cached by database file and filters (see select)
+    if filters:
+        key = (database_key(path),_filters_key(filters)) if rows is None else None
+        if key in _selections:
+            rows = _selections[key]
+        else:
+            mask = np.ones(meta['nrows'] if rows is None else len(rows),dtype=bool)
+            for label,values in filters.iteritems():
+                if meta['kinds'][label] == 'category':
+                    codes = np.load(os.path.join(path,meta['files'][label])+'.npy',mmap_mode='r')
+                    codes = codes if rows is None else codes[rows]
+                    mask &= _match_codes(codes,meta['categories'][label],values)
+                else:
+                    mask &= pd.Series(read(label,rows)).isin(values).values
+            rows = np.flatnonzero(mask) if rows is None else np.asarray(rows)[mask]
+            if not key is None:
+                _remember(key,rows)
+
+    index = meta['index'] if not meta['index'] is None else pd.RangeIndex(meta['nrows'])
+    if not rows is None:
+        index = index[rows]
+    data = pd.DataFrame(index=index)
+    for label in columns:
+        data[label] = read(label,rows)
+    return data
+
+
+'''Filter engine: row selections of databases by filters (keys=database label,
+values=a list of values; rows must match one of the values of every label) are
+computed as one boolean mask, on the category codes of categorical columns, and
+the resulting row positions are cached by database and filter content, so that
+repeated filters (e.g. by several ModelTests) are only evaluated once.'''
+_selections = collections.OrderedDict()
+_MAXSELECTIONS = 64
+
+'''Return a key identifying the contents of a database file (or of a columnar
+database directory): its path, size and modification time'''
+def database_key(filename):
+    if os.path.isdir(filename):
+        filename = os.path.join(filename,_METAFILE)
+    stat = os.stat(filename)
+    return (os.path.abspath(filename),stat.st_size,stat.st_mtime)
+
+'''Return the positions of the rows of data that match filters
+Inputs: data (DataFrame) :: the database
+        filters (dict)   :: keys=database label, values=a list of filter values
+        key (hashable)   :: if not None, identifies data (e.g. database_key(filename));
+                            the selection is cached for data and filters under key
+Output: rows (array)     :: positions of the matching rows (cached arrays are
+                            shared, do not modify them)'''
+def select(data,filters,key=None):
+    if not key is None:
+        key = (key,_filters_key(filters))
+        if key in _selections:
+            return _selections[key]
+
+    mask = np.ones(len(data),dtype=bool)
+    for label,values in filters.iteritems():
+        assert label in data.keys(), "{} is not a label in the database".format(label)
+        column = data[label]
+        if pd.api.types.is_categorical_dtype(column):
+            mask &= _match_codes(column.cat.codes.values,column.cat.categories,values)
+        else:
+            mask &= column.isin(values).values
+    rows = np.flatnonzero(mask)
+
+    if not key is None:
+        _remember(key,rows)
+    return rows
+
+# Filters as a hashable key, independent of the order of labels and values
+def _filters_key(filters):
+    return tuple(sorted((label,tuple(sorted(set(values)))) for label,values in filters.iteritems()))
+
+# Boolean array of the category codes that stand for one of values (code -1 is nan)
+def _match_codes(codes,categories,values):
+    table = np.zeros(len(categories)+1,dtype=bool)
+    wanted = pd.Index(categories).get_indexer(list(values))
+    table[wanted[wanted >= 0]] = True
+    return table[codes]
+
+# Cache a row selection, dropping the oldest ones beyond _MAXSELECTIONS
+def _remember(key,rows):
+    _selections[key] = rows
+    while len(_selections) > _MAXSELECTIONS:
+        _selections.popitem(last=False)
+
+
 class DataBase(object):
+    '''Genetic systems database (a pandas DataFrame, data). Hash indexes from tuples
+    of values in a set of columns to the positions of the rows that hold them are
+    built on the first ordered query on those columns (see get_indexes), extended
+    by add_data and remapped by remove_data and filter_data; assigning a new data
+    frame discards them.'''
 
     def __init__(self,data=None):
 
@@ -43,6 +258,17 @@ class DataBase(object):
         else:
             self.data = pd.DataFrame()
 
+        self._staged = []
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self,data):
+        self._data = data
+        self._indexes = {}
+
     def __repr__(self):
         return str(self.data)
 
@@ -67,11 +293,48 @@ class DataBase(object):
     '''Use add_data() to append data in form of DataFrame or dict
     Input: data :: Either a dictionary or a DataFrame'''
     def add_data(self,data):
-        assert isinstance(data,(dict,pd.DataFrame))
+        self.stage(data)
+        self.commit()
+
+    '''Use stage() to collect data to add to the DataBase with the next commit();
+    building a database from many datasets with stage() and a single commit()
+    copies the data once, instead of once per dataset as add_data() does
+    Input: data :: A dictionary (of columns), a DataFrame or a list of records (dicts)'''
+    def stage(self,data):
+        assert isinstance(data,(dict,list,pd.DataFrame))
         if isinstance(data,dict):
+            data = pd.DataFrame(remove_unicode(data))
+        elif isinstance(data,list):
             data = pd.DataFrame(data)
-        data = remove_unicode(data)
-        self.data = self.data.append(data,ignore_index=True)
+        self._staged.append(remove_unicode(data))
+
+    '''Use commit() to append all staged data to the DataBase with one concatenation
+    Input: categories (list) :: labels of columns to store as categoricals (e.g.
+                                DATASET, ORGANISM, PROTEIN); columns that are already
+                                categorical in the DataBase or in staged data stay
+                                categorical, with the categories of all data unified:
+                                existing categories (used or not) keep their order and
+                                new values are added in sorted order; ordered
+                                categoricals stay ordered and cannot gain categories'''
+    def commit(self,categories=()):
+        if not self._staged:
+            return
+        frames = [self._data] + self._staged if len(self._data.columns) else self._staged
+        labels = set(categories)
+        for frame in frames:
+            labels.update(label for label in frame.columns if pd.api.types.is_categorical_dtype(frame[label]))
+
+        # categoricals with different categories are concatenated as objects
+        # and converted to categoricals once, over the categories of all frames
+        start = len(self._data)
+        data = pd.concat(frames,ignore_index=True)
+        for label in labels:
+            if label in data.columns:
+                data[label] = _unify_categories(label,data[label],[frame[label] for frame in frames if label in frame.columns])
+        self._data = data
+        self._staged = []
+        for labels,index in self._indexes.iteritems():
+            self._update_index(index,labels,start)
 
     '''Use remove() to remove entries that match kargs
     Input:  database (pandas DataFrame)
@@ -80,7 +343,7 @@ class DataBase(object):
                                    of record attributes that are ordered            
     Output: Database filtered to remove kargs'''
     def remove_data(self,kargs,ordered=False):
-        self.data = self.data[~self.get_indexes(kargs,ordered)]
+        self._select(~self._matches(kargs,ordered))
 
     '''Use filter() to filter to remove all but a subset defined by kargs
     Input:  kargs (dictionary)  :: keys=database label, values=a list of filter values
@@ -88,9 +351,12 @@ class DataBase(object):
                                    of record attributes that are ordered
     Output: Database filtered to only include kargs'''
     def filter_data(self,kargs,ordered=False):
-        self.data = self.data[get_indexes(kargs,ordered)]
+        self._select(self._matches(kargs,ordered))
 
-    # Gets indexes for values in database that match kargs
+    # Gets indexes for values in database that match kargs: if ordered, the
+    # positions of the rows matching each query (the i-th values of all lists in
+    # kargs), looked up in a hash index on those labels (None for a query without
+    # matches if allQueries), else a boolean Series of rows matching any of the values
     def get_indexes(self,kargs,ordered=False,allQueries=False):
         assert isinstance(ordered,bool), "Argument, ordered, should be a boolean. Type given = {}".format(type(ordered))
         kargs = {k.upper(): v for k,v in kargs.iteritems()}
@@ -99,30 +365,93 @@ class DataBase(object):
             assert key in self.data.keys(), "{} is not a label in the database".format(key)
             keylist.append(key)
         if ordered:
+            index = self.index(keylist)
             indexes = []
-            for valuetup in zip(kargs.itervalues()):
-                boolarray = np.all([self.data[keylist[i]]==valuetup[i] for i in range(len(valuetup))],axis=1)
-                indx = [i for i,x in enumerate(boolarray) if x]
+            for valuetup in zip(*[kargs[key] for key in keylist]):
+                indx = index.get(valuetup)
                 if not indx:
                     indexes.append(None)
                 else:
                     indexes += indx
+            if not allQueries:
+                indexes = [indx for indx in indexes if not indx is None]
         else:
             indexes = self.data[kargs.keys()].isin(kargs).all(1)
-        if not allQueries:
-            indexes = [indx for indx in indexes[:] if not indx is None]
         return indexes
 
+    # Returns the hash index on labels: a dict from tuples of values to the
+    # positions of the rows that hold them (built on first use)
+    def index(self,labels):
+        labels = tuple(labels)
+        if not labels in self._indexes:
+            index = {}
+            self._update_index(index,labels,0)
+            self._indexes[labels] = index
+        return self._indexes[labels]
+
+    # Adds the rows of data from position start onwards to index
+    def _update_index(self,index,labels,start):
+        rows = zip(*[self._data[label].values[start:].tolist() for label in labels])
+        for i,valuetup in enumerate(rows,start):
+            if valuetup in index:
+                index[valuetup].append(i)
+            else:
+                index[valuetup] = [i]
+
+    # Boolean array of the rows that match kargs (see get_indexes)
+    def _matches(self,kargs,ordered):
+        if ordered:
+            mask = np.zeros(len(self._data),dtype=bool)
+            mask[self.get_indexes(kargs,True)] = True
+            return mask
+        return self.get_indexes(kargs,False).values
+
+    # Keeps the rows where keep is True, remapping the positions held by indexes
+    def _select(self,keep):
+        self._data = self._data[keep]
+        positions = np.cumsum(keep) - 1
+        for labels,index in self._indexes.items():
+            index = {valuetup: [int(positions[i]) for i in indx if keep[i]] for valuetup,indx in index.iteritems()}
+            self._indexes[labels] = {valuetup: indx for valuetup,indx in index.iteritems() if indx}
+
     '''Return Database as a list of dictionaries, where each entry (row)
     is a dictionary with the DataFrame labels as keys (sorted by index).'''
     def get_entries(self):
-        asDict = self.data.T.to_dict()
-        indxs = sorted(asDict.keys())
-        return [asDict[i] for i in indxs]
+        labels = list(self.data.columns)
+        return [dict(zip(labels,values)) for values in self.records()]
+
+    '''Iterate over the rows of the Database (sorted by index) as tuples of values,
+    converting chunksize rows at a time from the columns to Python values, so the
+    first rows are available at once and memory does not grow with the Database
+    Input:  columns (list)  :: labels of the values in each tuple (default: all)
+            chunksize (int) :: number of rows converted at a time
+    Output: generator of tuples'''
+    def records(self,columns=None,chunksize=10000):
+        assert chunksize > 0, "chunksize should be an int > 0"
+        if columns is None:
+            columns = list(self._data.columns)
+        for label in columns:
+            assert label in self._data.columns, "{} is not a label in the database".format(label)
+
+        order = None
+        if not self._data.index.is_monotonic_increasing:
+            order = np.argsort(self._data.index.values,kind='mergesort')
+        values = [self._data[label].values for label in columns]
+
+        for start in xrange(0,len(self._data),chunksize):
+            rows = slice(start,start+chunksize) if order is None else order[start:start+chunksize]
+            if not columns:
+                for _ in xrange(len(self._data.index[rows])):
+                    yield ()
+                continue
+            for record in zip(*[column[rows].tolist() for column in values]):
+                yield record
 
     '''Save the DataBase.data to ``filename`` for persistance;
     Input:  filename (string) :: Name of the file without extension to save to
-            type (string) :: Can be ``pickle`` (default) or ``csv`` '''
+            type (string) :: Can be ``pickle`` (default), ``csv`` or ``columns``
+                             (a columnar database directory named filename,
+                             see save_columns) '''
     def save(self,filename,type='pickle'):
 
         if filename.endswith('.csv'): fn = filename[:-4]
@@ -138,10 +467,28 @@ class DataBase(object):
         elif type == 'csv':
             self.data.to_csv(fn+'.csv')
 
+        # write to a directory with one file per column
+        elif type == 'columns':
+            save_columns(self.data,fn)
+
         else:
             raise Exception('Bad argument value for ``type`` in method DataBase.save().')
 
 
+'''Convert a concatenated column to a categorical with the categories of the
+categorical columns it was concatenated from (see DataBase.commit)'''
+def _unify_categories(label,column,columns):
+    categorical = [c for c in columns if pd.api.types.is_categorical_dtype(c)]
+    ordered = any(c.cat.ordered for c in categorical)
+    known = pd.Index([])
+    for c in categorical:
+        known = known.append(c.cat.categories[~c.cat.categories.isin(known)])
+    values = pd.Index(column.dropna().unique())
+    new = values[~values.isin(known)].sort_values()
+    if ordered and (len(new) or any(not c.cat.categories.equals(known) for c in categorical)):
+        raise Exception('Data added to the ordered categorical {} has other categories.'.format(label))
+    return pd.Categorical(column,categories=known.append(new),ordered=ordered)
+
 '''Use to remove unicode from a dict or a DataFrame'''
 def remove_unicode(d):
     for label in d.keys():
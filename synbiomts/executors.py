@@ -0,0 +1,275 @@
+"""
+Executor backends used by analyze.ModelTest to run model predictions:
+in the current process, with a local multiprocessing pool, or with remote
+worker processes that connect over a socket (possibly from other hosts).
+
+Copyright 2017 Alexander C. Reis, Howard M. Salis, all rights reserved.
+
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+import traceback
+import Queue
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+
+'''All executors share one method:
+    imap_unordered(func,tasks,initializer=None,initargs=())
+which calls initializer(*initargs) once in every worker, then yields func(task)
+for each of the tasks as soon as it is completed, in no particular order.'''
+
+
+class SerialExecutor(object):
+    '''Runs tasks one at a time in the current process.'''
+
+    def imap_unordered(self,func,tasks,initializer=None,initargs=()):
+        if not initializer is None:
+            initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+
+
+class PoolExecutor(object):
+    '''Runs tasks with a local multiprocessing.Pool of nprocesses workers.
+    Tasks are sent in chunks of chunksize; if None, chunksize is chosen from the
+    number of tasks and processes (as in Pool.map). If maxtasksperchild is not None,
+    each worker is replaced by a fresh process after completing that many tasks.
+    The pool is kept between calls with the same initializer and arguments (the
+    same objects), and replaced when they change; close() stops it.'''
+
+    def __init__(self,nprocesses=(mp.cpu_count()-1),chunksize=None,maxtasksperchild=None):
+        assert nprocesses > 0, "nprocesses should be an int > 0"
+        if not chunksize is None:
+            assert chunksize > 0, "chunksize should be an int > 0"
+        if not maxtasksperchild is None:
+            assert maxtasksperchild > 0, "maxtasksperchild should be an int > 0"
+        self.nprocesses = nprocesses
+        self.chunksize = chunksize
+        self.maxtasksperchild = maxtasksperchild
+        self._pool = None
+        self._initializer = None
+        self._initargs = ()
+
+    def _get_pool(self,initializer,initargs):
+        same = (initializer is self._initializer and len(initargs) == len(self._initargs)
+                and all(a is b for a,b in zip(initargs,self._initargs)))
+        if self._pool is None or not same:
+            self.close()
+            self._pool = mp.Pool(processes=self.nprocesses,initializer=initializer,initargs=initargs,
+                                 maxtasksperchild=self.maxtasksperchild)
+            (self._initializer,self._initargs) = (initializer,initargs)
+        return self._pool
+
+    def imap_unordered(self,func,tasks,initializer=None,initargs=()):
+        if not tasks:
+            return
+        chunksize = self.chunksize
+        if chunksize is None:
+            chunksize,extra = divmod(len(tasks),self.nprocesses*4)
+            if extra: chunksize += 1
+        pool = self._get_pool(initializer,initargs)
+        try:
+            for result in pool.imap_unordered(func,tasks,max(chunksize,1)):
+                yield result
+        except:
+            # an interrupted run leaves tasks in the workers; drop the pool
+            pool.terminate()
+            pool.join()
+            self._pool = None
+            raise
+
+    def close(self):
+        '''Stop the worker processes.'''
+        if not self._pool is None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        (self._initializer,self._initargs) = (None,())
+
+
+class RemoteExecutor(object):
+    '''Runs tasks on worker processes that connect to address, e.g. started on
+    other hosts (or on localhost) with serve() or from the command line:
+
+        $ python -m synbiomts.executors <host> <port> <authkey>
+
+    The executor listens on address (host,port) as soon as it is created; by default
+    only on localhost, use address=('',port) to accept workers from other hosts.
+    Workers may join or leave at any time, and stay connected between runs until
+    close() is called; the chunk of tasks held by a worker that disconnects is sent
+    to another worker. Connections are authenticated with authkey, a random key
+    (self.authkey) if none is given. Results sent by workers are unpickled, so anyone
+    who knows the authkey can run code on this host: keep it secret.
+
+    Workers unpickle the initializer, its arguments (for ModelTest, the models
+    Container) and func, so the wrapped model functions must be importable by the
+    worker; models defined in a script's __main__ need the worker to be started
+    from that same script with serve().'''
+
+    def __init__(self,address=('127.0.0.1',6000),authkey=None,chunksize=1):
+        assert chunksize > 0, "chunksize should be an int > 0"
+        if authkey is None:
+            authkey = os.urandom(16).encode('hex')
+        self.authkey = authkey
+        self.chunksize = chunksize
+        self.listener = Listener(address,authkey=authkey)
+        self.address = self.listener.address
+        self._idle = Queue.Queue() # connected workers waiting for a run
+        self._feeders = []
+        self._closed = threading.Event()
+        acceptor = threading.Thread(target=self._accept)
+        acceptor.daemon = True
+        acceptor.start()
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                continue
+            self._idle.put(conn)
+
+    def imap_unordered(self,func,tasks,initializer=None,initargs=()):
+        tasks = list(tasks)
+        chunks = Queue.Queue()
+        for i in xrange(0,len(tasks),self.chunksize):
+            chunks.put(tasks[i:i+self.chunksize])
+        results = Queue.Queue()
+        done = threading.Event()
+
+        def feed(conn):
+            '''Send chunks to one connected worker until all tasks are done.'''
+            chunk = None
+            try:
+                conn.send(('init',initializer,initargs))
+                (status,value) = conn.recv()
+                if status == 'error':
+                    # e.g. the worker cannot import the models; no task is sent to it
+                    results.put((status,value))
+                    done.wait()
+                while not done.is_set():
+                    try:
+                        chunk = chunks.get(timeout=0.5)
+                    except Queue.Empty:
+                        continue
+                    conn.send(('run',func,chunk))
+                    (status,value) = conn.recv()
+                    chunk = None
+                    results.put((status,value))
+            except (EOFError,IOError,socket.error):
+                # the worker has gone away, its chunk goes back into the queue
+                if not chunk is None:
+                    chunks.put(chunk)
+                conn.close()
+            else:
+                self._idle.put(conn)
+
+        def dispatch():
+            while not done.is_set():
+                try:
+                    conn = self._idle.get(timeout=0.5)
+                except Queue.Empty:
+                    continue
+                if done.is_set():
+                    self._idle.put(conn)
+                    break
+                thread = threading.Thread(target=feed,args=(conn,))
+                thread.daemon = True
+                thread.start()
+                self._feeders.append(thread)
+
+        dispatcher = threading.Thread(target=dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+        self._feeders.append(dispatcher)
+
+        try:
+            remaining = len(tasks)
+            while remaining > 0:
+                # poll so that KeyboardInterrupt is delivered while waiting on workers
+                try:
+                    (status,value) = results.get(timeout=1.0)
+                except Queue.Empty:
+                    continue
+                if status == 'error':
+                    raise Exception("Remote worker failed:\n" + value)
+                for result in value:
+                    yield result
+                remaining -= len(value)
+        finally:
+            done.set()
+
+    def close(self):
+        '''Stop listening and release connected workers.'''
+        self._closed.set()
+        # wait for the workers of the last run to be returned to the idle queue
+        for thread in self._feeders:
+            thread.join()
+        self._feeders = []
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                conn.send(('stop',None,None))
+            except (IOError,socket.error):
+                pass
+            conn.close()
+        self.listener.close()
+
+
+def serve(address,authkey,retry=True):
+    '''Run a remote worker for a RemoteExecutor listening on address (host,port),
+    authenticated with the executor's authkey.
+    With retry, the worker waits for the executor to start listening and reconnects
+    when the connection is lost, until the executor is closed.'''
+
+    while True:
+        try:
+            conn = Client(address,authkey=authkey)
+        except socket.error:
+            if not retry: raise
+            time.sleep(1.0)
+            continue
+        try:
+            while True:
+                try:
+                    (command,func,args) = conn.recv()
+                except (EOFError,IOError):
+                    raise
+                except Exception:
+                    # the message could not be unpickled, e.g. a model defined in the
+                    # executor's __main__; the executor raises the error
+                    conn.send(('error',traceback.format_exc()))
+                    continue
+                if command == 'init':
+                    try:
+                        if not func is None:
+                            func(*args)
+                        conn.send(('ok',None))
+                    except Exception:
+                        conn.send(('error',traceback.format_exc()))
+                elif command == 'run':
+                    try:
+                        conn.send(('ok',[func(task) for task in args]))
+                    except Exception:
+                        conn.send(('error',traceback.format_exc()))
+                else:
+                    return
+        except (EOFError,IOError):
+            pass
+        finally:
+            conn.close()
+        if not retry:
+            break
+        time.sleep(1.0)
+
+
+if __name__ == "__main__":
+    (host,port,authkey) = sys.argv[1:4]
+    serve((host,int(port)),authkey)
@@ -6,8 +6,14 @@ Copyright 2017 Alexander C. Reis, Howard M. Salis, all rights reserved.
   
 """
 
+import os
+import types
 import numbers
 import inspect
+import hashlib
+import tempfile
+import collections
+import cPickle as pickle
 from functools import partial
 
 '''
@@ -46,7 +52,10 @@ class Container(dict):
         The registered model will be given the attributes :attr:`__name__`
         set to the name and :attr:`__doc__` set to the original model's
         documentation. The :attr:`__dict__` attribute will also be updated
-        with the original model's instance dictionary, if any. '''
+        with the original model's instance dictionary, if any. The model's
+        remaining arguments are resolved once here: :attr:`arguments` lists
+        the arguments that are pulled from the database at call time, and
+        :attr:`columns` the (upper case) database labels that provide them. '''
         
         pmodel = partial(model, *args, **kargs)
         pmodel.__doc__ = model.__doc__
@@ -54,6 +63,12 @@ class Container(dict):
         ArgSpec = inspect.getargspec(model)
         pmodel.variables = ArgSpec[0]
 
+        # Remove args and keywords from variables list
+        vrs = pmodel.variables[len(args):]
+        pmodel.arguments = [k for k in vrs if k not in kargs]
+        pmodel.columns = tuple(k.upper() for k in pmodel.arguments)
+        pmodel.batch = False
+
         if hasattr(model, "__dict__") and not isinstance(model, type):
             # Some functions don't have a dictionary, in these cases
             # simply don't copy it. Moreover, if the model is actually
@@ -65,6 +80,21 @@ class Container(dict):
         self[name].set = False
         self.available = sorted(self.keys())
 
+    def add_batch(self, model, *args, **kargs):
+        '''Register a batch model with the model Container. A batch model is
+        called once for a block of database entries: each argument pulled from
+        the database is given as a list of values (one per entry), and the model
+        returns its results as a dictionary of lists (columns) of equal length.
+        Fixed arguments are provided as in :meth:`add`.
+
+            >>> def EMOPEC(sequence):
+            ...     return {'Expression': [lookup(seq) for seq in sequence]}
+            ...
+            >>> models.add_batch(EMOPEC)'''
+
+        self.add(model, *args, **kargs)
+        self[model.__name__].batch = True
+
     def remove(self, model):
         '''Unregister model from the model Container.
         model (string or function) = Can be a string or the function itself
@@ -115,5 +145,137 @@ class Container(dict):
         return self
 
 
+def fingerprint(model):
+    '''Identity of a registered model used to address cached predictions: the
+    wrapped function's module, name and compiled code (including nested functions),
+    its __version__ attribute if one is set, and the fixed arguments and keywords
+    given to Container.add. The alias given with Container.changeName is not used,
+    so renamed copies of the same model share cached predictions.'''
+
+    def code_hash(code,h):
+        h.update(code.co_code)
+        h.update(repr(code.co_names))
+        for const in code.co_consts:
+            if isinstance(const,types.CodeType): code_hash(const,h)
+            else: h.update(repr(const))
+
+    func = model.func if isinstance(model,partial) else model
+    h = hashlib.sha1()
+    h.update(repr((getattr(func,'__module__',None),getattr(func,'__name__',None))))
+    h.update(repr(getattr(model,'__version__',None)))
+    if hasattr(func,'func_code'):
+        code_hash(func.func_code,h)
+    if isinstance(model,partial):
+        h.update(repr(model.args))
+        h.update(repr(sorted((model.keywords or {}).items())))
+    return h.hexdigest()
+
+
+class PredictionCache(object):
+    '''Content-addressed, disk-backed store of model predictions. Each prediction is
+    saved as a pickle named by the hash of the model fingerprint (see fingerprint) and
+    the keyword arguments the model was called with. When the store grows beyond
+    maxsize bytes, the least recently used predictions are evicted until it is back
+    under lowwater*maxsize bytes. Sizes and recency of the entries are kept in memory
+    (read from the store once, when the cache is created), so a put never walks the
+    store; recency across sessions is kept by the files' modification times.
+
+        >>> cache = PredictionCache('.synbiomts_cache',maxsize=2**30)
+        >>> ModelTestSystem = synbiomts.analyze.ModelTest(models,dbfilename,cache=cache)
+        >>> ModelTestSystem.predict()
+        >>> print cache
+        PredictionCache(.synbiomts_cache): 1014 hits, 0 misses, 3.2 MB'''
+
+    def __init__(self,path,maxsize=2**30,lowwater=0.9):
+        assert maxsize > 0, "maxsize should be a number of bytes > 0"
+        assert 0 < lowwater <= 1, "lowwater should be a fraction of maxsize in (0,1]"
+        self.path = path
+        self.maxsize = maxsize
+        self.lowwater = lowwater
+        self.hits = 0
+        self.misses = 0
+        self._models = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # filename -> size, from least to most recently used
+        self._entries = collections.OrderedDict()
+        files = sorted((os.path.getmtime(fn),fn,os.path.getsize(fn)) for fn in self._files())
+        for _,fn,size in files:
+            self._entries[fn] = size
+        self.size = sum(self._entries.itervalues())
+
+    def __repr__(self):
+        fmt = "PredictionCache({}): {} hits, {} misses, {:.1f} MB"
+        return fmt.format(self.path,self.hits,self.misses,self.size/2.0**20)
+
+    def key(self,model,kargs):
+        '''Hash of the model identity and the keyword arguments of a model call.'''
+        if not id(model) in self._models:
+            self._models[id(model)] = (model,fingerprint(model))
+        h = hashlib.sha1(self._models[id(model)][1])
+        h.update(repr(sorted(kargs.items())))
+        return h.hexdigest()
+
+    def get(self,key):
+        '''Returns (True,prediction) if key is stored, else (False,None).'''
+        fn = self._filename(key)
+        try:
+            with open(fn,'rb') as handle:
+                value = pickle.load(handle)
+        except (IOError,EOFError,pickle.UnpicklingError):
+            self.misses += 1
+            return (False,None)
+        os.utime(fn,None) # mark as recently used
+        if fn in self._entries:
+            self._entries[fn] = self._entries.pop(fn)
+        self.hits += 1
+        return (True,value)
+
+    def put(self,key,value):
+        '''Store value under key, then evict least recently used entries if needed.'''
+        fn = self._filename(key)
+        folder = os.path.dirname(fn)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # write to a temporary file first so that readers never see partial entries
+        fd,tmp = tempfile.mkstemp(dir=folder)
+        with os.fdopen(fd,'wb') as handle:
+            pickle.dump(value,handle,protocol=2)
+            size = handle.tell()
+        os.rename(tmp,fn)
+        self.size += size - self._entries.pop(fn,0)
+        self._entries[fn] = size
+        if self.size > self.maxsize:
+            self.evict()
+
+    def evict(self,target=None):
+        '''Remove least recently used entries until the store is within target bytes
+        (default: lowwater*maxsize).'''
+        if target is None:
+            target = self.lowwater*self.maxsize
+        while self.size > target and self._entries:
+            (fn,size) = self._entries.popitem(last=False)
+            try:
+                os.remove(fn)
+            except OSError:
+                pass # already removed by another process
+            self.size -= size
+
+    def clear(self):
+        for fn in self._files():
+            os.remove(fn)
+        self._entries.clear()
+        self.size = 0
+
+    def _filename(self,key):
+        return os.path.join(self.path,key[:2],key+'.p')
+
+    def _files(self):
+        for root,_,filenames in os.walk(self.path):
+            for fn in filenames:
+                if fn.endswith('.p'):
+                    yield os.path.join(root,fn)
+
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
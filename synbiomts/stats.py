@@ -6,10 +6,10 @@ Copyright 2017 Alexander C. Reis, Howard M. Salis, all rights reserved.
 """
 
 from __future__ import division
-import re
 import numpy as np
 import scipy
 import scipy.stats
+import scipy.special
 
 def correlation(x,y,name="Pearson"):
     # Linear or rank correlation
@@ -93,6 +93,65 @@ def ttest2(x,y,alpha=0.05):
     h = pvalue < alpha
     return (h,t,pvalue)
 
+def permutation_counts(x,y,nperm,logNormal=False,seed=None,blocksize=1000):
+    '''Randomization test counts for equal variances and means of two samples
+
+    The labels of the pooled samples are permuted nperm times; each permutation is
+    a random subset of len(x) of the pooled values (drawn with argpartition of a
+    random matrix), and the statistics of blocks of permutations are computed at once.
+    Inputs:
+        x, y (arrays)    = the two samples
+        nperm (int)      = number of permutations
+        logNormal (bool) = if True, compare variances of log(x) and log(y) (as vartest2)
+        seed (int)       = seed of the random permutations
+        blocksize (int)  = number of permutations computed together
+    Returns:
+        S (array)      = observed statistics: [log variance ratio, difference of means]
+        counts (array) = number of permutations with an absolute statistic at least
+                         as large as the observed one, for each statistic'''
+
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    (nx,ny) = (len(x),len(y))
+    assert nx > 1 and ny > 1, "Arrays x & y must have at least two values."
+    pooled = np.concatenate((x,y))
+    logs = np.log(pooled) if logNormal else pooled
+    n = nx + ny
+
+    def statistics(sums,logsums,logsquares):
+        # variance & mean of the nx selected values (x) and of the others (y)
+        varx = logsquares/nx - (logsums/nx)**2
+        vary = (logsquares_total - logsquares)/ny - ((logsums_total - logsums)/ny)**2
+        return np.log(varx/vary),sums/nx - (sums_total - sums)/ny
+
+    (sums_total,logsums_total,logsquares_total) = (pooled.sum(),logs.sum(),np.sum(logs**2))
+    S = np.array(statistics(pooled[:nx].sum(),logs[:nx].sum(),np.sum(logs[:nx]**2)))
+    # tolerance for permutations that reproduce the observed statistic up to rounding
+    observed = np.absolute(S)*(1 - 1e-12)
+
+    rng = np.random.RandomState(seed)
+    counts = np.zeros(2,dtype=np.int64)
+    for start in xrange(0,nperm,blocksize):
+        size = min(blocksize,nperm - start)
+        indx = np.argpartition(rng.rand(size,n),nx-1,axis=1)[:,:nx]
+        L = logs[indx]
+        (var,mean) = statistics(pooled[indx].sum(axis=1),L.sum(axis=1),np.sum(L*L,axis=1))
+        counts += [np.sum(np.absolute(var) >= observed[0]),np.sum(np.absolute(mean) >= observed[1])]
+    return S,counts
+
+def permutation_test2(x,y,nperm=10000,logNormal=False,alpha=0.05,seed=None):
+    '''Two-sample permutation tests for equal variances and equal means
+    (see permutation_counts); the p-value of each test is (counts+1)/(nperm+1)
+    Returns:
+        h (array) = True if the test rejects the null hypothesis, for [variance, mean]
+        S (array) = the test statistics: [log variance ratio, difference of means]
+        pvalue (array) = the p-values for significance of test decisions'''
+
+    (S,counts) = permutation_counts(x,y,nperm,logNormal,seed)
+    pvalue = (counts + 1)/(nperm + 1)
+    h = pvalue < alpha
+    return (h,S,pvalue)
+
 def fit_linear_model(x,y,slope=None):
     '''Linear least squares (LSQ) linear regression (polynomial fit of degree=1)
     Returns:
@@ -164,9 +223,79 @@ def empirical_cdf(data,bins,rangemin=None,rangemax=None):
 
     return ecdf,edges
 
-def area_under_ROC_curve(predictions,observations,cutoff=None,n=50):
+def roc_curve(predictions,outcomes):
+    '''Calculate the exact ROC curve of predictions for binary outcomes
+
+    The predictions are sorted once and the confusion matrix is accumulated at
+    every distinct prediction value (ties move together along the curve).
+    Inputs:
+        predictions (array) = scores; a higher score predicts a positive outcome
+        outcomes (array)    = booleans, True for positive outcomes
+    Returns:
+        fpr (array) = false positive rates, from 0 to 1
+        tpr (array) = true positive rates, from 0 to 1
+        thresholds (array) = score thresholds (predictions >= threshold are
+                             positive) for each point of the curve'''
+
+    predictions = np.asarray(predictions,dtype=np.float64)
+    outcomes = np.asarray(outcomes,dtype=bool)
+    assert len(predictions)==len(outcomes), "Arrays predictions & outcomes must be equal length."
+
+    order = np.argsort(-predictions,kind='mergesort')
+    scores = predictions[order]
+    last = np.append(np.flatnonzero(np.diff(scores)),len(scores)-1)
+    tps = np.cumsum(outcomes[order])[last]
+    fps = (last+1) - tps
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        tpr = np.append(0.0,tps/tps[-1])
+        fpr = np.append(0.0,fps/fps[-1])
+    thresholds = np.append(np.inf,scores[last])
+    return fpr,tpr,thresholds
+
+def auroc(predictions,outcomes):
+    '''Calculate the exact area under the ROC curve for one or many prediction vectors
+
+    Uses the rank-sum (Mann-Whitney U) form of the area, with tied predictions given
+    their average rank, which equals the trapezoidal area under roc_curve.
+    Inputs:
+        predictions (array) = scores, a vector or a matrix with one vector per row
+        outcomes (array)    = booleans, a vector shared by all rows or one per row
+    Returns:
+        auroc (float or array) = area under the ROC curve for each prediction vector
+                                 (nan if outcomes are all positive or all negative)'''
+
+    predictions = np.asarray(predictions,dtype=np.float64)
+    scores = np.atleast_2d(predictions)
+    outcomes = np.asarray(outcomes,dtype=bool) * np.ones(scores.shape,dtype=bool)
+    (m,n) = scores.shape
+
+    # sort each row, then find the runs of tied scores (runs never cross rows)
+    order = np.argsort(scores,axis=1,kind='mergesort')
+    rows = np.arange(m)[:,np.newaxis]
+    scores = scores[rows,order]
+    outcomes = outcomes[rows,order]
+    new = np.ones((m,n),dtype=bool)
+    new[:,1:] = scores[:,1:] != scores[:,:-1]
+    new = new.ravel()
+    starts = np.flatnonzero(new)
+    ends = np.append(starts[1:],m*n) - 1
+    ranks = ((starts % n + ends % n)/2.0 + 1)[np.cumsum(new)-1].reshape(m,n)
+
+    P = outcomes.sum(axis=1)
+    N = n - P
+    U = np.sum(ranks*outcomes,axis=1) - P*(P+1)/2.0
+    with np.errstate(divide='ignore',invalid='ignore'):
+        area = U/(P*N)
+    return area if predictions.ndim > 1 else area[0]
+
+def area_under_ROC_curve(predictions,observations,cutoff=None):
     '''Calculate ROC curve and the area under the curve (auc)
 
+    Outcomes are positive when observations > cutoff (default: the median).
+    predictions may be a matrix with one prediction vector per row, in which case
+    auroc is an array and fpr, tpr and thresholds are lists with one curve per row.
+
     Returns:
         auroc (float) = area under the ROC curve
         fpr (array) = false positive rates
@@ -174,60 +303,17 @@ def area_under_ROC_curve(predictions,observations,cutoff=None,n=50):
         thresholds (array) = thresholds from ROC curve'''
 
     # define outcomes as TRUE/FALSE defined by cutoff
-    if cutoff == None: cutoff = np.median(outcomes)
-    outcomes = (observations > cutoff)
-
-    # preallocate arrays and define n-many threshodls
-    fpr = np.zeros(n)
-    tpr = np.zeros(n)
-    thresholds = np.linspace(0.9*min(observations),1.1*max(observations),n)
-
-    for i in xrange(0,n):
-
-        threshold = thresholds[i]
-        scores = predictions > threshold
-
-        # calculate confusion matrix
-        a = sum(scores & outcomes)
-        b = sum(scores & ~outcomes)
-        c = sum(~scores & outcomes)
-        d = sum(~scores & ~outcomes)            
-
-        # calculate fpr and tpr for each threshold
-        fpr[i] = b/(b+d)
-        tpr[i] = a/(a+c)
-
-    # Remove nans
-    nans = np.isnan(fpr) + np.isnan(tpr)
-    x = np.array(fpr)
-    y = np.array(tpr)
-    x = x[~nans]
-    y = y[~nans]
+    if cutoff is None: cutoff = np.median(observations)
+    outcomes = (np.asarray(observations) > cutoff)
 
-    # Sort by increasing x
-    indx = np.argsort(x)
-    x = x[indx]
-    y = y[indx]
-
-    # Remove repeated elements
-    x,indx = np.unique(x,return_index=True)
-    y = y[indx]
-
-    # Add (0,0) or (1,1) if not present!
-    if x[0]!=0.0:
-        x = np.append([0.0],x)
-        y = np.append([0.0],y)
-
-    if x[-1]!=1.0:
-        x = np.append(x,1.0)
-        y = np.append(y,1.0)
-
-    # Calculate area under the ROC curve
-    fpr = x
-    tpr = y
-    auroc = np.trapz(tpr,fpr)
+    area = auroc(predictions,outcomes)
+    if np.ndim(predictions) > 1:
+        curves = [roc_curve(p,outcomes) for p in predictions]
+        (fpr,tpr,thresholds) = [list(c) for c in zip(*curves)]
+    else:
+        (fpr,tpr,thresholds) = roc_curve(predictions,outcomes)
 
-    return auroc,fpr,tpr,thresholds
+    return area,fpr,tpr,thresholds
 
 def normKLdiv(data,b):
     '''Calculate normalized Kullback-Leibler divergence
@@ -324,6 +410,13 @@ def model_capacity(Hseq,mu,sigma,error):
 
     return (MC,Hmodel,Hrandom,N,CV)
 
+# Lookup table from ASCII codes to nucleotide indexes (A,T,C,G); U is read as T,
+# other letters are invalid (255) and the padding symbol X of aligned sequences is 4
+_nt_codes = np.empty(256,dtype=np.uint8)
+_nt_codes.fill(255)
+for _i,_nts in enumerate(['Aa','TtUu','Cc','Gg']):
+    for _nt in _nts: _nt_codes[ord(_nt)] = _i
+
 def sequence_entropy(sequences,align="left",positions=None):
     '''Calculate total Shannon sequence entropy
 
@@ -335,66 +428,310 @@ def sequence_entropy(sequences,align="left",positions=None):
                             (e.g. start codon positions)
     Returns:
         hseq (float) = total Shannon sequence entropy summed over all positions
-        S (array)    = Shannon sequence entropy at each position'''
+        S (array)    = Shannon sequence entropy at each position
 
-    sequences = [seq.upper().replace("U","T") for seq in sequences[:]]
-    exp = re.compile('[ATGC]')
-    if any([exp.match(seq) is None for seq in sequences]):
-        raise ValueError("Invalid letters found in sequences. Only ATGCU accepted.")
+    Sequences of unequal length are aligned to the left or right (as given by
+    align) or else at positions, and padded with X, which is counted as a fifth
+    letter. Sequences are encoded once into an array of nucleotide indexes and
+    the letters at each position are counted with a single bincount.'''
 
+    sequences = [str(seq) for seq in sequences]
     nseqs = len(sequences)
-    maxseqlen = max([len(seq) for seq in sequences])
-    samelen   = all([len(sequences[0])==len(seq) for seq in sequences[1:]])
+    lengths = np.array([len(seq) for seq in sequences],dtype=np.int64)
+    codes = _nt_codes[np.frombuffer("".join(sequences),dtype=np.uint8)]
+    if np.any(codes == 255):
+        raise ValueError("Invalid letters found in sequences. Only ATGCU accepted.")
+
+    maxseqlen = lengths.max()
+    samelen   = np.all(lengths == lengths[0])
 
     if   align == "left" and not samelen:
         # align sequences to left and buffer right with Xs
-        sequences = [seq+"X"*(maxseqlen-len(seq)) for seq in sequences[:]]
+        offsets = np.zeros(nseqs,dtype=np.int64)
+        seqlen = maxseqlen
 
     elif align == "right" and not samelen:
         # align sequences to the right by buffering left with Xs
-        sequences = ["X"*(maxseqlen-len(seq))+seq for seq in sequences[:]]
+        offsets = maxseqlen - lengths
+        seqlen = maxseqlen
 
     elif not positions is None:
         # align sequences at alignment_positions and buffer both ends with Xs
-        lefts     = [len(seq[0:pos]) for seq,pos in zip(sequences,positions)]
-        rights    = [len(seq[pos:]) for seq,pos in zip(sequences,positions)]
-        maxleft   = max(lefts)
-        maxright  = max(rights)
-        sequences = ["X"*(maxleft-L)+seq+"X"*(maxright-R) for L,seq,R in zip(lefts,sequences[:],rights)]
-        
-    else:
-        raise ValueError("align cannot be {}. Please use 'left','right',or positions".format(align))
+        # (lefts and rights follow slicing of seq[0:pos] and seq[pos:])
+        positions = np.asarray(positions,dtype=np.int64)
+        lefts   = np.where(positions < 0,np.maximum(lengths+positions,0),np.minimum(positions,lengths))
+        rights  = lengths - lefts
+        offsets = lefts.max() - lefts
+        seqlen  = lefts.max() + rights.max()
 
-    # Code test
-    assert all(len(sequences[0])==len(seq) for seq in sequences[1:])
+    elif samelen and align in ("left","right"):
+        offsets = np.zeros(nseqs,dtype=np.int64)
+        seqlen = maxseqlen
 
-    # tabulate frequency of each nt at each position
-    if samelen: alphabet = 'ATCG'
-    else:       alphabet = 'ATCGX'
-    counts = {key: np.zeros(maxseqlen) for key in alphabet}
+    else:
+        raise ValueError("align cannot be {}. Please use 'left','right',or positions".format(align))
 
-    for seq in sequences:
-        for i,c in enumerate(seq):
-            counts[c][i] += 1
-    
-    pkList = [[counts[c][i]/nseqs for c in alphabet] for i in xrange(maxseqlen)]
+    # tabulate frequency of each nt at each position: the column of each letter is
+    # its offset in the sequence plus the offset of its sequence in the alignment
+    starts = np.cumsum(lengths) - lengths
+    columns = np.arange(len(codes)) - np.repeat(starts - offsets,lengths)
+    counts = np.bincount(columns*5 + codes,minlength=seqlen*5).reshape(seqlen,5)
+    counts[:,4] = nseqs - counts[:,:4].sum(axis=1)
 
     # calculate Shannon entropy at each position and total Shannon entropy (hseq)
-    S = [entropy(pk,base=2) for pk in pkList]
+    # (as with scipy.stats.entropy: normalize pk, then sum pk*log(pk) over letters)
+    pk = counts/nseqs
+    pk = pk/pk.sum(axis=1)[:,np.newaxis]
+    S = list(scipy.special.entr(pk).sum(axis=1)/np.log(2))
     Hseq = sum(S)
 
     return Hseq,S
 
-def linear_complete(xVals,yVals,ystd,xScale='linear',yScale='linear',slope=None):
+def n_states(yVals,ystd,yScale='linear',transformed=False):
+    '''Number of distinguishable states of a set of measurements
+
+    Inputs:
+        yVals (array) = measured means (already on yScale if transformed is True)
+        ystd (array)  = standard deviations of the measurements (nan if unknown)
+        yScale (str)  = 'linear', 'ln' or 'log10' scale on which states are counted
+    Returns:
+        N (int)    = number of distinguishable states over the range of yVals
+                     (0 if no standard deviations are known)
+        CV (float) = mean coefficient of variation on yScale
+
+    N and CV depend only on the data (not on a model), so they can be computed once
+    and passed to linear_complete and linear_simple as states=(N,CV).'''
+
+    yVals = np.array(yVals, dtype=np.float64)
+    if not transformed:
+        if   yScale == 'log10': yVals = np.log10(yVals)
+        elif yScale == 'ln':    yVals = np.log(yVals)
+
+    ystd = np.array(ystd, dtype=np.float64)
+    nans = np.isnan(ystd)
+    ystd = ystd[~nans]
+    yVals = yVals[~nans]
+
+    if len(ystd)==0:
+        return (0.0,0.0)
+
+    if   yScale == 'log10': ystd = np.log10(ystd)
+    elif yScale == 'ln':    ystd = np.log(ystd)
+    else: pass
+
+    nonzero = np.nonzero(ystd*yVals)
+    ystd = ystd[nonzero]
+    yVals = yVals[nonzero]
+
+    negative = (yVals < 0.0) + (ystd < 0.0)
+    CV = np.mean(ystd[~negative]/yVals[~negative])
+    N = int(np.floor((max(yVals) - min(yVals))/CV))
+    return (N,CV)
+
+# Bin edges of the one-sided model error cdfs (2-, 5- and 10-fold errors are
+# the cdf at the bins ending at edges 3, 6 and 20, as in linear_complete)
+_fold_edges = np.concatenate((np.linspace(1,10,10),np.linspace(20,100,9),np.linspace(200,1000,9)))
+
+def bootstrap_linear(xVals,yVals,yScale='linear',fit=True,slope=None,nboot=1000,alpha=0.05,seed=None,blocksize=100):
+    '''Bootstrap confidence intervals of the statistics of linear_complete/linear_simple
+
+    Resamples are drawn in blocks of blocksize rows of an (nboot,n) matrix of row
+    indexes, and the outlier-trimmed fits, correlations, fold-error cdfs and AUROCs
+    are computed for all resamples of a block together, without calling
+    linear_complete nboot times; memory is bounded by the block, and the intervals
+    do not depend on blocksize.
+    Inputs:
+        xVals, yVals (arrays) = predictor and measurements, already on xScale & yScale
+        yScale (str)   = 'linear', 'ln' or 'log10' scale of yVals (sets the fold error)
+        fit (bool)     = if True, refit y = a1*x + a0 to each resample as in
+                         linear_complete, else x predicts y directly (linear_simple)
+        slope (float)  = if not None, fixed slope a1 of the fits
+        nboot (int)    = number of bootstrap resamples
+        alpha (float)  = the intervals are the (alpha/2, 1-alpha/2) percentiles
+        seed (int)     = seed of the random resampling
+        blocksize (int) = number of resamples computed together
+    Returns:
+        CIs (dict) = "<statistic> CI.low" and "<statistic> CI.high" for each statistic'''
+
+    assert len(xVals)==len(yVals), "Arrays xVals & yVals must be equal length."
+    assert nboot > 0, "nboot should be an int > 0"
+    assert blocksize > 0, "blocksize should be an int > 0"
+
+    xVals = np.asarray(xVals,dtype=np.float64)
+    yVals = np.asarray(yVals,dtype=np.float64)
+    n = len(yVals)
+    rng = np.random.RandomState(seed)
+    blocks = []
+    for start in xrange(0,nboot,blocksize):
+        # consecutive blocks of rows drawn from one RandomState are the rows of a
+        # single (nboot,n) draw
+        indx = rng.randint(0,n,size=(min(blocksize,nboot-start),n))
+        blocks.append(_bootstrap_block(xVals,yVals,indx,yScale,fit,slope))
+    samples = {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
+
+    CIs = {}
+    for name,values in samples.items():
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            (low,high) = (np.nan,np.nan)
+        else:
+            (low,high) = np.percentile(values,[50*alpha,100 - 50*alpha])
+        CIs[name + " CI.low"] = low
+        CIs[name + " CI.high"] = high
+    return CIs
+
+def _bootstrap_block(x,y,indx,yScale,fit,slope):
+    '''Statistics of the resamples (rows of row indexes indx) of the points x & y
+    for bootstrap_linear; returns a dict of arrays with one value per resample.
+
+    A resample is represented by the number of times it draws each point (counts),
+    so that its sums are sums over the n points weighted by the counts, and only
+    the medians of the outlier test are taken over the drawn values. Within a
+    resample the predictions a1*x + a0 are ranked as x (reversed if a1 < 0), so the
+    AUROCs only need x to be sorted once.'''
+
+    (m,n) = indx.shape
+    rows = np.arange(m)[:,np.newaxis]
+    counts = np.bincount((indx + n*rows).ravel(),minlength=m*n).reshape(m,n).astype(np.float64)
+    samples = {}
+
+    def weighted_moments(w):
+        # means and sums of squares about the means of x & y for each row of weights w
+        N = w.sum(axis=1)
+        (mx,my) = (np.dot(w,x)/N,np.dot(w,y)/N)
+        (dx,dy) = (x - mx[:,np.newaxis],y - my[:,np.newaxis])
+        wdx = w*dx
+        return N,mx,my,np.einsum('ij,ij->i',wdx,dx),np.einsum('ij,ij->i',wdx,dy),dy
+
+    def linear_fit(moments):
+        # least squares fit of y on x for each row of weights (see weighted_moments)
+        (N,mx,my,Sxx,Sxy,_) = moments
+        if slope is None:
+            a1 = Sxy/Sxx
+        else:
+            a1 = slope*np.ones(m)
+        return a1,my - a1*mx
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        # Pearson correlation of x & y of each resample; the predictions of a fit are
+        # a linear function of x, so they have the same R-squared (unless a1 is 0)
+        moments = weighted_moments(counts)
+        (N,mx,my,Sxx,Sxy,dy) = moments
+        Syy = np.einsum('ij,ij->i',counts*dy,dy)
+        R = np.clip(Sxy/np.sqrt(Sxx*Syy),-1.0,1.0)
+
+        if fit:
+            # determine outliers with initial fit (see find_outliers), then refit
+            (a1,a0) = linear_fit(moments)
+            delta = np.absolute(x - (y - a0[:,np.newaxis])/a1[:,np.newaxis])
+            # (the medians may reorder the drawn values of each resample in place)
+            drawn = delta[rows,indx]
+            median = np.median(drawn,axis=1,overwrite_input=True)[:,np.newaxis]
+            MAD = np.median(np.absolute(drawn - median),axis=1,overwrite_input=True)[:,np.newaxis]
+            keepers = ~(np.absolute(delta - median) > 2*MAD/0.6745)
+            (a1,a0) = linear_fit(weighted_moments(counts*keepers))
+            P = a1[:,np.newaxis]*x + a0[:,np.newaxis]
+            R[~(np.isfinite(a1) & (a1 != 0))] = np.nan
+            samples["slope"] = a1
+            samples["intercept"] = a0
+        else:
+            P = x
+
+        samples["Pearson R-squared"] = R**2.0
+        samples["RMSE"] = np.sqrt(1-R**2.0)*np.sqrt(Syy/N)
+
+        # One-sided model error cdfs: the draws of each resample are counted in the bins
+        # of the fold error max(yError,1/yError) (on the ln and log10 scales, exp|y - P|
+        # and 10**|y - P|) below 1, up to the 2, 5 and 10-fold edges and above them
+        edges = _fold_edges[[0,2,5,10]]
+        if yScale == 'linear':
+            yError = y/P
+            yError = np.maximum(yError,1/yError)
+        else:
+            yError = np.absolute(y - P)
+            edges = np.log10(edges) if yScale == 'log10' else np.log(edges)
+        bins = np.searchsorted(edges,yError,side='right')
+        if bins.ndim == 1:
+            drawn = np.dot(counts,(bins[:,np.newaxis] == np.arange(5)).astype(np.float64))
+        else:
+            drawn = np.bincount((bins + 5*rows).ravel(),weights=counts.ravel(),minlength=5*m).reshape(m,5)
+        cdf = np.cumsum(drawn[:,1:4],axis=1)/n
+        for j,name in enumerate(["2-fold Error","5-fold Error","10-fold Error"]):
+            samples[name] = cdf[:,j]
+
+        # AUC ROC, with the threshold of each resample: in order of x, each positive
+        # draw counts the negative draws below its run of tied predictions, and half
+        # of those in its run (the cumulative negatives before the run's first point
+        # and after its last point); predictions a1*x + a0 of distinct x may be tied
+        # by rounding, so the runs are found for each resample
+        Y = y[indx]
+        threshold = (Y.max(axis=1) + Y.min(axis=1))/2.0
+        order = np.argsort(x,kind='mergesort')
+        drawn = counts[:,order]
+        positives = drawn*(y[order] > threshold[:,np.newaxis])
+        negatives = drawn - positives
+        after = np.cumsum(negatives,axis=1)
+        before = after - negatives
+        ranked = np.atleast_2d(P[:,order] if fit else x[order])
+        first = np.ones(ranked.shape,dtype=bool)
+        first[:,1:] = ranked[:,1:] != ranked[:,:-1]
+        if not first.all():
+            last = np.ones(ranked.shape,dtype=bool)
+            last[:,:-1] = first[:,1:]
+            index = np.arange(n)
+            first = np.maximum.accumulate(np.where(first,index,0),axis=1)
+            last = n - 1 - np.maximum.accumulate(np.where(last,n - 1 - index,0)[:,::-1],axis=1)[:,::-1]
+            (before,after) = (before[rows,first],after[rows,last])
+        U = np.einsum('ij,ij->i',positives,before + after)/2.0
+        area = U/(positives.sum(axis=1)*negatives.sum(axis=1))
+        if fit:
+            area = np.where(a1 > 0,area,np.where(a1 < 0,1 - area,np.where(a1 == 0,0.5,np.nan)))
+        samples["AUROC"] = area
+
+    return samples
+
+class FitContext(object):
+    '''Measurements of a set of rows, prepared once for the fits of every model
+
+    The measurements are transformed to yScale, and their distinguishable states
+    (see n_states), the bin edges of the RIG histogram and the AUROC threshold are
+    computed once, so that linear_complete and linear_simple can be run for many
+    models on the same rows (e.g. a subgroup) without repeating them.
+    Inputs:
+        yVals (array)  = measured means
+        ystd (array)   = standard deviations of the measurements (nan if unknown)
+        yScale (str)   = 'linear', 'ln' or 'log10' scale of the fits
+        states (tuple) = if not None, (N,CV) of the measurements from n_states'''
+
+    def __init__(self,yVals,ystd,yScale='linear',states=None):
+        self.measured = np.asarray(yVals,dtype=np.float64)
+        if   yScale == 'log10':  self.yVals = np.log10(self.measured)
+        elif yScale == 'ln':     self.yVals = np.log(self.measured)
+        elif yScale == 'linear': self.yVals = self.measured
+        else: raise ValueError("Invalid input in FitContext for yScale: {}".format(yScale))
+        self.ystd = np.asarray(ystd,dtype=np.float64)
+        self.yScale = yScale
+
+        if states is None:
+            states = n_states(self.yVals,self.ystd,yScale,transformed=True)
+        self.states = states
+        self.edges = np.linspace(-4,4,states[0]+1) if states[0] > 0 else None
+        self.threshold = (max(self.yVals) + min(self.yVals))/2.0
+
+def linear_complete(xVals,yVals,ystd,xScale='linear',yScale='linear',slope=None,states=None,nboot=0,seed=None,context=None):
+    '''Fit y = a1*x + a0 (outliers removed) and calculate the model statistics.
+    If context (a FitContext on yScale) is not None, the measurements yVals, ystd
+    and states are taken from it and may be None.'''
 
     # Useful lambda functions
     calc_x = lambda a0,a1,y: (y-a0)/a1
     calc_y = lambda a0,a1,x: a1*x+a0
 
-    if   yScale == 'log10':  yVals = np.log10(yVals)
-    elif yScale == 'ln':     yVals = np.log(yVals)
-    elif yScale == 'linear': pass
-    else: raise ValueError("Invalid input in ModelTest._linear_model_stats for yScale: {}".format(yScale))
+    if context is None:
+        context = FitContext(yVals,ystd,yScale,states)
+    elif context.yScale != yScale:
+        raise ValueError("FitContext on {} scale given for yScale: {}".format(context.yScale,yScale))
+    yVals = context.yVals
 
     if   xScale == 'log10':  xVals = np.log10(xVals)
     elif xScale == 'ln':     xVals = np.log(xVals)
@@ -433,41 +770,24 @@ def linear_complete(xVals,yVals,ystd,xScale='linear',yScale='linear',slope=None)
 
     # One-sided model error cdfs
     yError1 = np.array([1/val if val < 1 else val for val in yError])
-    bins = np.concatenate((np.linspace(1,10,10),np.linspace(20,100,9),np.linspace(200,1000,9)))
+    bins = _fold_edges
     onesided_cdf,_ = empirical_cdf(yError1,bins)
 
     # Kullback-Leibler divergence
     (NKLdiv,KLdiv,KLdivmax) = normKLdiv(yError,b=4)
 
     # AUC ROC
-    threshold = (max(yVals) + min(yVals))/2.0
+    threshold = context.threshold
     auroc,fpr,tpr,thresholds = area_under_ROC_curve(y_predicted,yVals,cutoff=threshold)
 
     # Relative information gain (RIG) over uniform model
-    # remove nans from ystd
-    # if len(ystd)==0, then skip information theory analysis
-    ystd = np.array(ystd, dtype=np.float64)
-    nans = np.isnan(ystd)
-    ystd = ystd[~nans]
-    yVals = yVals[~nans]
+    # if no ystd are known (N == 0), then skip information theory analysis
+    (N,CV) = context.states
 
-    if len(ystd)==0:
-        CV = 0.0
-        N = 0.0
+    if N == 0:
         RIG = 0.0
     else:
-        if   yScale == 'log10': ystd = np.log10(ystd)
-        elif yScale == 'ln':    ystd = np.log(ystd)
-        else: pass
-
-        nonzero = np.nonzero(ystd*yVals)
-        ystd = ystd[nonzero]
-        yVals = yVals[nonzero]
-
-        negative = (yVals < 0.0) + (ystd < 0.0)
-        CV = np.mean(ystd[~negative]/yVals[~negative])
-        N = int(np.floor((max(yVals) - min(yVals))/CV))
-        edges = np.linspace(-4,4,N+1)
+        edges = context.edges
         # filter out residuals that don't fall in the bins
         rmv = (residuals < edges[0]) + (residuals > edges[-1])
         residuals = residuals[~rmv]
@@ -478,7 +798,6 @@ def linear_complete(xVals,yVals,ystd,xScale='linear',yScale='linear',slope=None)
         dist = np.ones(N)/N;
         Hrandom = entropy(dist)
         RIG = 1 - Hmodel/Hrandom
-    # WARNING yVals and y_predicted have been modified after MC calculations
 
     results = {
     "Pearson R-squared": R**2.0,
@@ -501,16 +820,24 @@ def linear_complete(xVals,yVals,ystd,xScale='linear',yScale='linear',slope=None)
     "AUROC": auroc
     }
 
+    # Bootstrap confidence intervals (see bootstrap_linear)
+    if nboot > 0:
+        results.update(bootstrap_linear(xVals,yVals,yScale,fit=True,slope=slope,nboot=nboot,seed=seed))
+
     return results,yError
 
-def linear_simple(xVals,yVals,ystd,xScale='linear',yScale='linear'):
+def linear_simple(xVals,yVals,ystd,xScale='linear',yScale='linear',states=None,nboot=0,seed=None,context=None):
+    '''Calculate the model statistics of x as a direct prediction of y.
+    If context (a FitContext on yScale) is not None, the measurements yVals, ystd
+    and states are taken from it and may be None.'''
 
-    yError = yVals/xVals
+    if context is None:
+        context = FitContext(yVals,ystd,yScale,states)
+    elif context.yScale != yScale:
+        raise ValueError("FitContext on {} scale given for yScale: {}".format(context.yScale,yScale))
 
-    if yScale == 'log10':    yVals = np.log10(yVals)
-    elif yScale == 'ln':     yVals = np.log(yVals)
-    elif yScale == 'linear': pass
-    else: raise ValueError("Invalid input in ModelTest._linear_model_stats for yScale: {}".format(yScale))
+    yError = context.measured/xVals
+    yVals = context.yVals
 
     if xScale == 'log10':    xVals = np.log10(xVals)
     elif xScale == 'ln':     xVals = np.log(xVals)
@@ -530,42 +857,25 @@ def linear_simple(xVals,yVals,ystd,xScale='linear',yScale='linear'):
 
     # One-sided model error cdfs
     yError1 = np.array([1/val if val < 1 else val for val in yError])
-    bins = np.concatenate((np.linspace(1,10,10),np.linspace(20,100,9),np.linspace(200,1000,9)))
+    bins = _fold_edges
     onesided_cdf,_ = empirical_cdf(yError1,bins)
 
     # Kullback-Leibler divergence
     (NKLdiv,KLdiv,KLdivmax) = normKLdiv(yError,b=4)
 
     # AUC ROC
-    threshold = (max(yVals) + min(yVals))/2.0
+    threshold = context.threshold
     auroc,fpr,tpr,thresholds = area_under_ROC_curve(xVals,yVals,cutoff=threshold)
 
     # Relative entropy gain over uniform model
     # Relative information gain (RIG) over uniform model
-    # remove nans from ystd
-    # if len(ystd)==0, then skip information theory analysis
-    ystd = np.array(ystd, dtype=np.float64)
-    nans = np.isnan(ystd)
-    ystd = ystd[~nans]
-    yVals = yVals[~nans]
-    
-    if len(ystd)==0:
-        CV = 0.0
-        N = 0.0
+    # if no ystd are known (N == 0), then skip information theory analysis
+    (N,CV) = context.states
+
+    if N == 0:
         RIG = 0.0
     else:
-        if   yScale == 'log10': ystd = np.log10(ystd)
-        elif yScale == 'ln':    ystd = np.log(ystd)
-        else: pass
-
-        nonzero = np.nonzero(ystd*yVals)
-        ystd = ystd[nonzero]
-        yVals = yVals[nonzero]
-
-        negative = (yVals < 0.0) + (ystd < 0.0)
-        CV = np.mean(ystd[~negative]/yVals[~negative])
-        N = int(np.floor((max(yVals) - min(yVals))/CV))
-        edges = np.linspace(-4,4,N+1)
+        edges = context.edges
         # filter out residuals that don't fall in the bins
         rmv = (residuals < edges[0]) + (residuals > edges[-1])
         residuals = residuals[~rmv]
@@ -576,7 +886,6 @@ def linear_simple(xVals,yVals,ystd,xScale='linear',yScale='linear'):
         dist = np.ones(N)/N;
         Hrandom = entropy(dist)
         RIG = 1 - Hmodel/Hrandom
-    # WARNING yVals and y_predicted have been modified after MC calculations
 
     # Number of outliers
     outliers = find_outliers(yError)
@@ -600,6 +909,10 @@ def linear_simple(xVals,yVals,ystd,xScale='linear',yScale='linear'):
     "AUROC": auroc
     }
 
+    # Bootstrap confidence intervals (see bootstrap_linear)
+    if nboot > 0:
+        results.update(bootstrap_linear(xVals,yVals,yScale,fit=False,nboot=nboot,seed=seed))
+
     return results,yError
 
 if __name__ == "__main__":